@@ -1,144 +1,228 @@
 # -*- coding: utf-8 -*-
 import os
+import heapq
 import argparse
+import multiprocessing
 import operator
 import math
 import json
 import jieba
 import similarity
-from csv_parser import read_csv_with_headers
+from csv_parser import iter_csv_rows
+from CodeDictionary import CodeDictionary
+from trans_store import read_trans, is_trans_store
+from catalogue import load_snapshot
+from pattern_output import open_pattern_writer
 from misc import check_keys
-from collections import defaultdict
+from collections import defaultdict, Counter, deque
 
 class ActionPatternMiner(object):
     """
         This class infers call reasons for call transactions
+        output configures where and how the patterns are written:
+          dir             - output directory, default .
+          format          - one of pattern_output.FORMATS, default tsv
+          top_n           - patterns per reason/action and items per action, 0 for all
+          min_support     - minimum frequency of an output pattern, default 0
+          min_probability - minimum probability of an item in the stats, default 0.1
     """
-    def __init__(self, trcode, call_reason, trans_file):
+    DEFAULT_OUTPUT = {"dir": ".", "format": "tsv", "top_n": 0, "min_support": 0, "min_probability": 0.1}
+
+    def __init__(self, trcode, call_reason, trans_file, snapshot="", output=None):
         check_keys(["file_name"], call_reason, "call_reason", basestring)
         check_keys(["call_reason_id_index", "call_reason_index"], call_reason, "call_reason", int)
         check_keys(["file_name"], trcode, "trcode", basestring)
         check_keys(["code_id_index", "code_type_index", "code_name_index", "code_reason_index"], trcode, "trcode", int)
-        if not os.path.isfile(trans_file):
+        if not os.path.isfile(trans_file) and not is_trans_store(trans_file):
             raise Exception("{0} does not exist.".format(trans_file))
+        self._output = dict(self.DEFAULT_OUTPUT)
+        if output is not None:
+            self._output.update(output)
+        check_keys(["dir", "format"], self._output, "output", basestring)
+        check_keys(["top_n", "min_support"], self._output, "output", int)
+        check_keys(["min_probability"], self._output, "output", (int, float))
         self._call_reason_setting = call_reason
         self._call_reasons = {}
         self._trans_file = trans_file
+        self._snapshot = snapshot
         self._trans = []
         self._trcode = trcode
+        self._code_dict = CodeDictionary()
         self._code_mapping = {}
-        self._action_pattern = {}
-        self._action_stats = {}
-        self._load_code_mapping()
-        self._load_call_reasons()
+        self._action_pattern = Counter()
+        self._action_totals = Counter()
+        self._action_stats = Counter()
+        snapshot_content = None
+        if snapshot != "":
+            snapshot_content = load_snapshot(snapshot, trcode, call_reason)
+        if snapshot_content is not None:
+            self._load_snapshot(snapshot_content)
+        else:
+            self._load_code_mapping()
+            self._load_call_reasons()
+
+    def _load_snapshot(self, snapshot):
+        """Loads the catalogues from a snapshot compiled by ReasonInferrer"""
+        for code, code_info in snapshot["codes"]:
+            self._code_mapping[self._code_dict.encode(code)] = list(code_info)
+        for reason_id, reason in snapshot["call_reasons"]:
+            self._call_reasons[reason_id] = reason
 
     def _load_code_mapping(self):
-        _, lines = read_csv_with_headers(self._trcode['file_name'])
-        for line in lines:
-            code_id = line[self._trcode["code_id_index"]]
-            code_type = line[self._trcode["code_type_index"]].strip()
-            code_name = line[self._trcode["code_name_index"]].strip()
-            code_reason = line[self._trcode["code_reason_index"]].strip()
-            self._code_mapping[code_id] = [code_type, code_name, code_reason]
+        columns = [self._trcode[key] for key in ["code_id_index", "code_type_index", "code_name_index", "code_reason_index"]]
+        for code, code_type, code_name, code_reason in iter_csv_rows(self._trcode['file_name'], columns):
+            code_id = self._code_dict.encode(code)
+            self._code_mapping[code_id] = [code_type.strip(), code_name.strip(), code_reason.strip()]
 
     def _load_call_reasons(self):
-        _, lines = read_csv_with_headers(self._call_reason_setting['file_name'])
-        id_index = self._call_reason_setting['call_reason_id_index']
-        reason_index = self._call_reason_setting['call_reason_index']
-        for line in lines:
-            self._call_reasons[line[id_index]] = line[reason_index].strip()
-
-    def mine_patterns(self):
-        with open(self._trans_file, 'r') as f:
-            for line in f:
-                items = line.split('\t')
-                one_seg = []
-                freq = int(items[-1])
-                for item in items[:-1]:
-                    if item == 'C108021':
-                        continue
-                    if item in self._code_mapping:
-                        code_type, chinese_part, code_reason = self._code_mapping[item]
-                        one_seg.append('{0}({1})'.format(item, chinese_part))
-                        if code_type == '2':
-                            self._handle_one_pattern(one_seg, code_reason, freq)
-                            self._stat_one_pattern(one_seg, freq)
-                            one_seg = []
-                    else:
-                        one_seg.append(item+'()')
+        columns = [self._call_reason_setting['call_reason_id_index'], self._call_reason_setting['call_reason_index']]
+        for reason_id, reason in iter_csv_rows(self._call_reason_setting['file_name'], columns):
+            self._call_reasons[reason_id] = reason.strip()
+
+    def mine_patterns(self, workers=1, chunk_size=10000):
+        """Counts the action patterns of all transactions and outputs them.
+           With workers > 1, chunks of transactions are counted by a pool of
+           processes and their counters merged.
+        """
+        skipped_id = self._code_dict.encode('C108021')
+        chunks = self._read_chunks(chunk_size)
+        if workers <= 1:
+            for chunk in chunks:
+                self._merge_counts(self._count_patterns(chunk, skipped_id))
+            self._output_patterns()
+            return
+        pool = multiprocessing.Pool(workers, _init_worker, (self._trcode, self._call_reason_setting, self._trans_file, self._snapshot, self._output))
+        try:
+            pending = deque()
+            while True:
+                # Keep a bounded number of chunks in flight
+                while len(pending) < 2 * workers:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    pending.append(pool.apply_async(_count_chunk, (chunk, skipped_id)))
+                if len(pending) == 0:
+                    break
+                self._merge_counts(pending.popleft().get())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
         self._output_patterns()
 
+    def _read_chunks(self, chunk_size):
+        chunk = []
+        for code_ids, freq in read_trans(self._trans_file, self._code_dict):
+            chunk.append((code_ids, freq))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def _count_patterns(self, chunk, skipped_id):
+        """Returns Counters of (reason id, action, pattern), action and
+           (action, item), where codes are ids and patterns tuples of ids.
+           Ids of codes in trcode are the same in every process.
+        """
+        action_pattern = Counter()
+        action_totals = Counter()
+        action_stats = Counter()
+        code_mapping = self._code_mapping
+        for code_ids, freq in chunk:
+            one_seg = []
+            for code_id in code_ids:
+                if code_id == skipped_id:
+                    continue
+                one_seg.append(code_id)
+                code_info = code_mapping.get(code_id)
+                if code_info is not None and code_info[0] == '2':
+                    prefix = one_seg[:-1]
+                    action_pattern[(code_info[2], code_id, self._gen_pattern(prefix))] += freq
+                    action_totals[code_id] += freq
+                    for item in set(prefix):
+                        action_stats[(code_id, item)] += freq
+                    one_seg = []
+        return action_pattern, action_totals, action_stats
+
+    def _merge_counts(self, counts):
+        action_pattern, action_totals, action_stats = counts
+        self._action_pattern.update(action_pattern)
+        self._action_totals.update(action_totals)
+        self._action_stats.update(action_stats)
+
     def _gen_pattern(self, raw_pattern):
-        pre_item = 'Nil'
+        pre_item = None
         clean_pattern = []
         for item in raw_pattern:
             if item != pre_item:
                 clean_pattern.append(item)
                 pre_item = item
-        return clean_pattern
-
-    def _stat_one_pattern(self, one_pattern, freq):
-        if one_pattern[-1] not in self._action_stats:
-            self._action_stats[one_pattern[-1]] = {}
-        if 'total' not in self._action_stats[one_pattern[-1]]:
-            self._action_stats[one_pattern[-1]]['total'] = 0
-        self._action_stats[one_pattern[-1]]['total'] += freq
-        if len(one_pattern) > 1:
-            clean_pattern = set(one_pattern[:-1])
-            for item in clean_pattern:
-                if item not in self._action_stats[one_pattern[-1]]:
-                    self._action_stats[one_pattern[-1]][item] = 0
-                self._action_stats[one_pattern[-1]][item] += freq
-
-    def _handle_one_pattern(self, one_pattern, reason, freq):
-        if reason == '':
-            reason = 'Unknow'
-        else:
-            reason = self._call_reasons[reason]
-        if reason not in self._action_pattern:
-            self._action_pattern[reason] = {}
-        if one_pattern[-1] not in self._action_pattern[reason]:
-            self._action_pattern[reason][one_pattern[-1]] = {}
-        pattern = ''
-        if len(one_pattern) == 1:
-            pattern = 'Nil'
-        else:
-            pattern = ','.join(self._gen_pattern(one_pattern[:-1]))
-        if pattern not in self._action_pattern[reason][one_pattern[-1]]:
-            self._action_pattern[reason][one_pattern[-1]][pattern] = 0
-        self._action_pattern[reason][one_pattern[-1]][pattern] += freq
+        return tuple(clean_pattern)
+
+    def _code_label(self, code_id):
+        if code_id in self._code_mapping:
+            return '{0}({1})'.format(self._code_dict.decode(code_id), self._code_mapping[code_id][1])
+        return self._code_dict.decode(code_id) + '()'
+
+    def _select(self, items):
+        """Returns the top_n (key, count) items by count, or all of them if top_n is 0"""
+        if self._output["top_n"] > 0:
+            return heapq.nlargest(self._output["top_n"], items, key=operator.itemgetter(1))
+        return sorted(items, key=operator.itemgetter(1), reverse=True)
 
     def _output_patterns(self):
-        with open('action_pattern.txt', 'w') as f:
-            for reason in self._action_pattern:
-                for action in self._action_pattern[reason]:
-                    f.write('{0}\t{1}:\n'.format(reason, action))
-                    pattern_sorted = sorted(self._action_pattern[reason][action].items(), key=operator.itemgetter(1), reverse=True)
-                    for pattern, freq in pattern_sorted:
-                        f.write('{0}:{1},{2}\t{3}\n'.format(reason, pattern, action, freq))
-        with open('pattern_stat.txt', 'w') as f:
-            for action in self._action_stats:
-                total = self._action_stats[action]['total']
-                items_sorted = sorted(self._action_stats[action].items(), key=operator.itemgetter(1), reverse=True)
-                item_with_freq = []
-                for item, freq in items_sorted:
-                    if item == 'total':
-                        continue
+        min_support = self._output["min_support"]
+        action_pattern = defaultdict(lambda: defaultdict(Counter))
+        for (reason, action, pattern), freq in self._action_pattern.iteritems():
+            reason = 'Unknow' if reason == '' else self._call_reasons[reason]
+            action_pattern[reason][action][pattern] += freq
+        action_stats = defaultdict(list)
+        for (action, item), freq in self._action_stats.iteritems():
+            action_stats[action].append((item, freq))
+        writer = open_pattern_writer(self._output["format"], self._output["dir"])
+        try:
+            for reason in action_pattern:
+                for action in action_pattern[reason]:
+                    action_label = self._code_label(action)
+                    writer.begin_action(reason, action_label)
+                    patterns = ((pattern, freq) for pattern, freq in action_pattern[reason][action].iteritems()
+                        if freq >= min_support)
+                    for pattern, freq in self._select(patterns):
+                        writer.pattern(reason, action_label, [self._code_label(item) for item in pattern], freq)
+            for action, total in self._action_totals.iteritems():
+                item_with_prob = []
+                for item, freq in self._select(action_stats[action]):
                     prob = freq*1.0/total
-                    if prob < 0.1:
+                    if prob < self._output["min_probability"]:
                         continue
-                    item_with_freq.append('{0}({1:.2f})'.format(item, prob))
-                f.write('{0} : {1}...\n'.format(action, ','.join(item_with_freq)))
+                    item_with_prob.append((self._code_label(item), prob))
+                writer.stat(self._code_label(action), total, item_with_prob)
+        finally:
+            writer.close()
+
+
+# ActionPatternMiner of a worker process, loaded once by _init_worker
+_worker_miner = None
+
+def _init_worker(trcode, call_reason, trans_file, snapshot, output):
+    global _worker_miner
+    _worker_miner = ActionPatternMiner(trcode, call_reason, trans_file, snapshot, output)
+
+def _count_chunk(chunk, skipped_id):
+    return _worker_miner._count_patterns(chunk, skipped_id)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--setting', default='settings.json', help='setting of ReasonInferrer, default settings.json')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='worker processes, default 1')
     args = parser.parse_args()
     with open(args.setting, 'r') as f:
         setting = json.load(f)
-        pattern_miner = ActionPatternMiner(setting['trcode'], setting['call_reason'], setting['trans_stat_output'])
-        pattern_miner.mine_patterns()
+        pattern_miner = ActionPatternMiner(setting['trcode'], setting['call_reason'], setting['trans_stat_output'],
+            setting.get('catalogue_snapshot', ''), setting.get('pattern_output'))
+        pattern_miner.mine_patterns(args.workers)
 
 
 if __name__ == '__main__':
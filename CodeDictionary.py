@@ -0,0 +1,87 @@
+from array import array
+from csv_parser import iter_csv_rows
+from misc import check_keys
+
+
+class CodeDictionary(object):
+    """
+        This class maps transaction codes to dense integer ids.
+        Codes in the trcode file get the first ids in file order, unseen
+        codes are appended as they show up. Transactions are carried as
+        array('H') of ids instead of lists of code strings.
+    """
+    TYPECODE = 'H'
+    MAX_CODES = 1 << 16
+
+    def __init__(self, trcode=None):
+        self._codes = []
+        self._ids = {}
+        if trcode is not None:
+            check_keys(["file_name"], trcode, "trcode", basestring)
+            check_keys(["code_id_index"], trcode, "trcode", int)
+            for code, in iter_csv_rows(trcode['file_name'], [trcode["code_id_index"]]):
+                self.encode(code)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __contains__(self, code):
+        return code in self._ids
+
+    def encode(self, code):
+        """Returns the id of code, assigning a new one if it is unseen"""
+        code_id = self._ids.get(code)
+        if code_id is None:
+            code_id = len(self._codes)
+            if code_id >= self.MAX_CODES:
+                raise Exception('More than {0} distinct codes, {1} can not be encoded.'.format(self.MAX_CODES, code))
+            self._ids[code] = code_id
+            self._codes.append(code)
+        return code_id
+
+    def get_id(self, code, default=None):
+        """Returns the id of code without assigning a new one"""
+        return self._ids.get(code, default)
+
+    def decode(self, code_id):
+        return self._codes[code_id]
+
+    def encode_seq(self, codes):
+        return array(self.TYPECODE, [self.encode(code) for code in codes])
+
+    def decode_seq(self, code_ids):
+        return [self._codes[code_id] for code_id in code_ids]
+
+    def key_of(self, code_ids):
+        """Returns a compact hashable key for an id sequence"""
+        return code_ids.tostring()
+
+    def seq_of(self, key):
+        """Inverse of key_of"""
+        code_ids = array(self.TYPECODE)
+        code_ids.fromstring(key)
+        return code_ids
+
+    @property
+    def codes(self):
+        return self._codes
+
+    def read_trans_file(self, file_name):
+        """Generates (code ids, frequency) of every line of a trans_stat file"""
+        with open(file_name, 'r') as f:
+            for line in f:
+                items = line.split('\t')
+                yield self.encode_seq(items[:-1]), int(items[-1])
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            for code in self._codes:
+                f.write('{0}\n'.format(code))
+
+    @classmethod
+    def load(cls, file_name):
+        code_dict = cls()
+        with open(file_name, 'r') as f:
+            for line in f:
+                code_dict.encode(line.rstrip('\n'))
+        return code_dict
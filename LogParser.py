@@ -1,70 +1,435 @@
+import os
 import sys
+import json
+import heapq
+import shutil
 import operator
+import tempfile
+import multiprocessing
+from array import array
 from misc import check_keys
-from datetime import datetime
+from CodeDictionary import CodeDictionary
+from trans_store import write_trans_store
+from log_input import expand_inputs, detect_compression, iter_lines
+from datetime import datetime, timedelta
 from collections import defaultdict
 
 
+def _parse_line(line, service_log, filter_str):
+    """Returns (trans_id, trans_code, date_str) of a log line, or None if filtered out"""
+    items = line.split('\t')
+    trans_id = items[service_log["trans_id_index"]]
+    if filter_str != "" and trans_id[:len(filter_str)] != filter_str:
+        return None
+    return trans_id, items[service_log["trans_code_index"]], items[service_log["date_index"]]
+
+def _parse_date(date_str, date_cache):
+    """Parses a '%Y-%m-%d' date, memoized on the raw string"""
+    date = date_cache.get(date_str)
+    if date is None:
+        try:
+            date = datetime.strptime(date_str, '%Y-%m-%d')
+        except:
+            raise Exception('Invalid date {0}'.format(date_str))
+        date_cache[date_str] = date
+    return date
+
+def _split_file(file_name, shard_number):
+    """Splits a file into at most shard_number newline-aligned byte ranges"""
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    with open(file_name, 'rb') as f:
+        for i in range(1, shard_number):
+            pos = max(size * i / shard_number, offsets[-1])
+            if pos > 0:
+                # Move to the start of the first line beginning at or after pos
+                f.seek(pos - 1)
+                f.readline()
+                pos = f.tell()
+            offsets.append(min(pos, size))
+    offsets.append(size)
+    return [(offsets[i], offsets[i+1]) for i in range(shard_number) if offsets[i] < offsets[i+1]]
+
+def _shard_lines(file_name, start, end):
+    """Generates the lines in [start, end) of a plain file, or every line
+       of a compressed file when end is None
+    """
+    if end is None:
+        for line in iter_lines(file_name):
+            yield line
+        return
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+def _parse_shard(args):
+    """Parses the lines in [start, end) of a log file.
+       The codes and the code lists are returned in first-seen order of the
+       code and the trans_id, so that shards merged in order reproduce the
+       code ids and the result of the single-threaded path.
+    """
+    file_name, start, end, service_log, filter_str = args
+    date_filter = service_log.get("filter_by_date", False)
+    start_date = datetime.strptime(service_log["start_date"], '%Y-%m-%d')
+    end_date = datetime.strptime(service_log["end_date"], '%Y-%m-%d')
+    date_cache = {}
+    current_date_str = None
+    in_range = True
+    trans = {}
+    trans_order = []
+    codes = set()
+    code_order = []
+    for line in _shard_lines(file_name, start, end):
+        record = _parse_line(line, service_log, filter_str)
+        if record is None:
+            continue
+        trans_id, trans_code, date_str = record
+        # Dates are only converted when the raw string changes
+        if date_str != current_date_str:
+            current_date_str = date_str
+            date = _parse_date(date_str, date_cache)
+            in_range = not date_filter or start_date <= date <= end_date
+        if not in_range:
+            continue
+        if trans_id not in trans:
+            trans[trans_id] = []
+            trans_order.append(trans_id)
+        trans[trans_id].append(trans_code)
+        if trans_code not in codes:
+            codes.add(trans_code)
+            code_order.append(trans_code)
+    return code_order, [(trans_id, trans[trans_id]) for trans_id in trans_order]
+
+def _read_stat(file_name):
+    """Reads a trans_stat text file into a dict of tab-joined codes to count"""
+    stat = defaultdict(int)
+    with open(file_name, 'r') as f:
+        for line in f:
+            trans_key, count = line.rstrip('\n').rsplit('\t', 1)
+            stat[trans_key] += int(count)
+    return stat
+
+def _write_stat(file_name, stat):
+    # Written aside and renamed, a crash never leaves a partial file behind
+    with open(file_name + '.tmp', 'w') as f:
+        for trans_key, count in stat.iteritems():
+            f.write("{0}\t{1}\n".format(trans_key, count))
+    os.rename(file_name + '.tmp', file_name)
+
+def _read_manifest(file_name):
+    """Returns the sorted days total.txt was built from, None if unknown"""
+    if not os.path.isfile(file_name):
+        return None
+    try:
+        with open(file_name, 'r') as f:
+            return sorted(str(day) for day in json.load(f)["days"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _merge_stat(total, stat, sign):
+    for trans_key, count in stat.iteritems():
+        total[trans_key] += sign * count
+        if total[trans_key] == 0:
+            del total[trans_key]
+
+def _read_run(file_name):
+    """Reads back the (trans_id, seq, trans_code) records of a sorted spill run"""
+    with open(file_name, 'r') as f:
+        for line in f:
+            trans_id, seq, trans_code = line.rstrip('\n').split('\t')
+            yield trans_id, int(seq), trans_code
+
+
 class LogParser(object):
     """LogParser class
        It passes the servicelog, stats frequency of all call trasactions.
        The stat result will be output into a file
+       service_log["file_name"] is a path, a glob pattern or a list of them,
+       gzip/bz2/xz files are decompressed on the fly.
+       Transactions are kept as arrays of code ids of code_dict.
+
+       service_log["aggregation"] selects how transactions are collected:
+         memory  - keep every transaction's codes until the log is read (default)
+         grouped - the log is grouped by trans_id, a transaction is folded into
+                   the stat as soon as its id changes
+         spill   - like grouped, but an unsorted log is first sorted externally
+                   in runs of service_log["spill_lines"] records, written to
+                   a temporary directory under service_log["spill_dir"]
+                   (default the system temporary directory)
+       service_log["workers"] > 1 reads the log in parallel, which only the
+       memory aggregation supports.
+       With service_log["filter_by_date"] set, lines dated outside
+       [start_date, end_date] are skipped.
     """
-    def __init__(self, service_log, filter_str = ""):
-        check_keys(["file_name", "start_date", "end_date"], service_log, 'service_log', basestring)
+    AGGREGATIONS = ('memory', 'grouped', 'spill')
+
+    def __init__(self, service_log, filter_str = "", code_dict=None):
+        check_keys(["file_name"], service_log, 'service_log', (basestring, list))
+        check_keys(["start_date", "end_date"], service_log, 'service_log', basestring)
         check_keys(["date_index", "trans_id_index", "trans_code_index"], service_log, 'service_log', int)
+        if "filter_by_date" in service_log:
+            check_keys(["filter_by_date"], service_log, 'service_log', bool)
+        if "workers" in service_log:
+            check_keys(["workers"], service_log, 'service_log', int)
+        if "spill_lines" in service_log:
+            check_keys(["spill_lines"], service_log, 'service_log', int)
+        if "spill_dir" in service_log:
+            check_keys(["spill_dir"], service_log, 'service_log', basestring)
+        if "aggregation" in service_log:
+            check_keys(["aggregation"], service_log, 'service_log', basestring)
+            if service_log["aggregation"] not in self.AGGREGATIONS:
+                raise Exception('Aggregation {0} is not one of {1}.'.format(service_log["aggregation"], self.AGGREGATIONS))
+            if service_log["aggregation"] != 'memory' and service_log.get("workers", 1) > 1:
+                raise Exception('Aggregation {0} does not support workers > 1.'.format(service_log["aggregation"]))
         self._service_log = service_log
         self._filter = filter_str
-        self._trans = defaultdict(list)
+        self._workers = service_log.get("workers", 1)
+        self._date_filter = service_log.get("filter_by_date", False)
+        self._date_cache = {}
+        self._aggregation = service_log.get("aggregation", "memory")
+        self._spill_lines = service_log.get("spill_lines", 5000000)
+        self._code_dict = code_dict if code_dict is not None else CodeDictionary()
+        self._trans = defaultdict(lambda: array(CodeDictionary.TYPECODE))
+        self._trans_stat = defaultdict(int)
         self._trans_sorted = []
         self._code_2_meaning = {}
 
-    def process_and_store(self, file_name):
-        self._read_file()
-        self._make_trans_and_sort()
+    def process_and_store(self, file_name, binary_prefix=""):
+        if self._aggregation == 'grouped':
+            self._aggregate_grouped(self._iter_records())
+        elif self._aggregation == 'spill':
+            self._aggregate_grouped(self._iter_spilled(self._iter_records()))
+        else:
+            if self._workers > 1:
+                self._read_file_parallel()
+            else:
+                self._read_file()
+            self._make_trans_stat()
+        self._sort_trans_stat()
         self._store_result(file_name)
+        if binary_prefix != "":
+            self._store_binary(binary_prefix)
 
     def _store_result(self, file_name):
         with open(file_name, 'w') as f:
             for one_trans in self._trans_sorted:
-                f.write("{0}\t{1}\n".format(one_trans[0], one_trans[1]))
+                trans_codes = self._code_dict.decode_seq(self._code_dict.seq_of(one_trans[0]))
+                f.write("{0}\t{1}\n".format('\t'.join(trans_codes), one_trans[1]))
 
-    def _read_file(self):
+    def _iter_records(self, with_date=False):
+        """Generates (trans_id, trans_code) of every log line passing the filter,
+           or (trans_id, trans_code, date_str) if with_date is set
+        """
         current_date = datetime.strptime(self._service_log["start_date"], '%Y-%m-%d')
-        with open(self._service_log['file_name'], 'r') as f:
-            start_date = datetime.strptime(self._service_log["start_date"], '%Y-%m-%d')
-            end_date = datetime.strptime(self._service_log["end_date"], '%Y-%m-%d')
-            total_days = (end_date - start_date).days
-            for line in f:
-                items = line.split('\t')
-                trans_id = items[self._service_log["trans_id_index"]]
-                if self._filter != "" and trans_id[:len(self._filter)] != self._filter:
+        current_date_str = None
+        in_range = True
+        start_date = datetime.strptime(self._service_log["start_date"], '%Y-%m-%d')
+        end_date = datetime.strptime(self._service_log["end_date"], '%Y-%m-%d')
+        total_days = (end_date - start_date).days
+        for file_name in expand_inputs(self._service_log['file_name']):
+            for line in iter_lines(file_name):
+                record = _parse_line(line, self._service_log, self._filter)
+                if record is None:
                     continue
-                trans_code = items[self._service_log["trans_code_index"]]
-                date_str = items[self._service_log["date_index"]]
-                date = None
-                try:
-                    date = datetime.strptime(date_str, '%Y-%m-%d')
-                except:
-                    raise Exception('Invalid date {0}'.format(date_str))
-                #new day
-                if current_date != date:
-                    current_date = date
-                    percentage = str(100*(current_date - start_date).days/total_days)+'%'
-                    sys.stdout.write('Processing data on {0}... {1} accomplished\r'\
-                        .format(current_date.strftime('%Y-%m-%d'), percentage)) 
-                self._trans[trans_id].append(trans_code)
+                trans_id, trans_code, date_str = record
+                # Dates are only converted when the raw string changes
+                if date_str != current_date_str:
+                    current_date_str = date_str
+                    date = _parse_date(date_str, self._date_cache)
+                    in_range = not self._date_filter or start_date <= date <= end_date
+                    #new day
+                    if current_date != date:
+                        current_date = date
+                        percentage = str(100*(current_date - start_date).days/total_days)+'%'
+                        sys.stdout.write('Processing data on {0}... {1} accomplished\r'\
+                            .format(current_date.strftime('%Y-%m-%d'), percentage)) 
+                if not in_range:
+                    continue
+                yield (trans_id, trans_code, date_str) if with_date else (trans_id, trans_code)
         sys.stdout.write('\n')
+
+    def update_incremental(self, file_name, state_dir, window_days=0, binary_prefix=""):
+        """Merges the log into the per-day partial stats kept in state_dir
+           and stores the stat of all kept days, without rescanning old logs.
+           A transaction belongs to the day of its first record. Days in the
+           log replace the stored ones, days more than window_days before the
+           latest day are dropped; window_days 0 keeps every day.
+           total.txt is only trusted with a total.json listing the same days;
+           that file is removed while an update is in progress, so after a
+           crash the total is rebuilt from the day files.
+           The log is read serially in memory, so workers > 1 and the grouped
+           and spill aggregations are rejected.
+        """
+        if self._aggregation != 'memory':
+            raise Exception('Aggregation {0} is not supported by incremental update.'.format(self._aggregation))
+        if self._workers > 1:
+            raise Exception('Workers > 1 is not supported by incremental update.')
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        stored_days = set(name[4:-4] for name in os.listdir(state_dir)
+            if name.startswith('day-') and name.endswith('.txt'))
+        day_file = lambda day: os.path.join(state_dir, 'day-{0}.txt'.format(day))
+        total_file = os.path.join(state_dir, 'total.txt')
+        manifest_file = os.path.join(state_dir, 'total.json')
+        if os.path.isfile(total_file) and _read_manifest(manifest_file) == sorted(stored_days):
+            total = _read_stat(total_file)
+        else:
+            total = defaultdict(int)
+            for day in stored_days:
+                _merge_stat(total, _read_stat(day_file(day)), 1)
+        if os.path.isfile(manifest_file):
+            os.remove(manifest_file)
+        day_stats = self._read_file_by_day()
+        for day, stat in day_stats.iteritems():
+            if day in stored_days:
+                _merge_stat(total, _read_stat(day_file(day)), -1)
+            _write_stat(day_file(day), stat)
+            _merge_stat(total, stat, 1)
+        days = sorted(stored_days | set(day_stats))
+        if window_days > 0 and days:
+            first_day = _parse_date(days[-1], self._date_cache) - timedelta(days=window_days - 1)
+            for day in days:
+                if _parse_date(day, self._date_cache) < first_day:
+                    _merge_stat(total, _read_stat(day_file(day)), -1)
+                    os.remove(day_file(day))
+        _write_stat(total_file, total)
+        kept_days = [day for day in days if os.path.isfile(day_file(day))]
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump({"days": kept_days}, f)
+        os.rename(manifest_file + '.tmp', manifest_file)
+        print "days kept: ", len(kept_days)
+        for trans_key, count in total.iteritems():
+            self._trans_stat[self._code_dict.key_of(self._code_dict.encode_seq(trans_key.split('\t')))] = count
+        self._sort_trans_stat()
+        self._store_result(file_name)
+        if binary_prefix != "":
+            self._store_binary(binary_prefix)
+
+    def _read_file_by_day(self):
+        """Returns the stat of the log per day, keyed on tab-joined codes"""
+        encode = self._code_dict.encode
+        trans_day = {}
+        for trans_id, trans_code, date_str in self._iter_records(with_date=True):
+            if trans_id not in trans_day:
+                trans_day[trans_id] = date_str
+            self._trans[trans_id].append(encode(trans_code))
+        print "transaction number: ", len(self._trans)
+        day_stats = defaultdict(lambda: defaultdict(int))
+        for trans_id, trans_items in self._trans.iteritems():
+            day_stats[trans_day[trans_id]]['\t'.join(self._code_dict.decode_seq(trans_items))] += 1
+        self._trans.clear()
+        return day_stats
+
+    def _store_binary(self, prefix):
+        seq_of = self._code_dict.seq_of
+        records = ((seq_of(trans_key), count) for trans_key, count in self._trans_sorted)
+        write_trans_store(prefix, records, self._code_dict.codes)
+
+    def _read_file(self):
+        encode = self._code_dict.encode
+        for trans_id, trans_code in self._iter_records():
+            self._trans[trans_id].append(encode(trans_code))
         print "transaction number: ", len(self._trans)
 
-    def _make_trans_and_sort(self):
-    	trans_stat = defaultdict(int)
+    def _aggregate_grouped(self, records):
+        """Folds each transaction into the stat as soon as its trans_id changes.
+           A trans_id showing up again later is counted as a new transaction.
+        """
+        encode = self._code_dict.encode
+        key_of = self._code_dict.key_of
+        trans_number = 0
+        current_id = None
+        trans_codes = array(CodeDictionary.TYPECODE)
+        for trans_id, trans_code in records:
+            if trans_id != current_id:
+                if trans_codes:
+                    self._trans_stat[key_of(trans_codes)] += 1
+                    trans_number += 1
+                current_id = trans_id
+                trans_codes = array(CodeDictionary.TYPECODE)
+            trans_codes.append(encode(trans_code))
+        if trans_codes:
+            self._trans_stat[key_of(trans_codes)] += 1
+            trans_number += 1
+        print "transaction number: ", trans_number
+
+    def _iter_spilled(self, records):
+        """Sorts records by trans_id with sorted runs spilled to disk.
+           A sequence number keeps the original order of codes in a transaction.
+        """
+        spill_dir = tempfile.mkdtemp(prefix='logparser_', dir=self._service_log.get("spill_dir"))
+        try:
+            runs = []
+            buf = []
+            for seq, (trans_id, trans_code) in enumerate(records):
+                buf.append((trans_id, seq, trans_code))
+                if len(buf) >= self._spill_lines:
+                    runs.append(self._write_run(spill_dir, len(runs), buf))
+                    buf = []
+            if buf:
+                runs.append(self._write_run(spill_dir, len(runs), buf))
+                buf = []
+            for trans_id, _, trans_code in heapq.merge(*[_read_run(run) for run in runs]):
+                yield trans_id, trans_code
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    def _write_run(self, spill_dir, run_index, buf):
+        buf.sort()
+        run_file = os.path.join(spill_dir, 'run{0}'.format(run_index))
+        with open(run_file, 'w') as f:
+            for record in buf:
+                f.write('{0}\t{1}\t{2}\n'.format(*record))
+        return run_file
+
+    def _read_file_parallel(self):
+        """Parses the log in newline-aligned shards with a process pool.
+           Shards are merged in file order, so the code list of every
+           transaction is the same as the one _read_file builds.
+        """
+        files = expand_inputs(self._service_log['file_name'])
+        sizes = [os.path.getsize(file_name) for file_name in files]
+        total_size = max(sum(sizes), 1)
+        tasks = []
+        for file_name, size in zip(files, sizes):
+            if detect_compression(file_name) is not None:
+                # A compressed stream can not be split, it is one shard
+                tasks.append((file_name, 0, None, self._service_log, self._filter))
+                continue
+            # More shards than workers to balance uneven shards
+            shard_number = max(1, self._workers * 4 * size / total_size)
+            for start, end in _split_file(file_name, shard_number):
+                tasks.append((file_name, start, end, self._service_log, self._filter))
+        pool = multiprocessing.Pool(self._workers)
+        try:
+            for shard_index, (shard_codes, shard_trans) in enumerate(pool.imap(_parse_shard, tasks)):
+                for trans_code in shard_codes:
+                    self._code_dict.encode(trans_code)
+                for trans_id, trans_codes in shard_trans:
+                    self._trans[trans_id].extend(self._code_dict.encode_seq(trans_codes))
+                percentage = str(100*(shard_index + 1)/len(tasks))+'%'
+                sys.stdout.write('Processing shard {0}/{1}... {2} accomplished\r'\
+                    .format(shard_index + 1, len(tasks), percentage))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        sys.stdout.write('\n')
+        print "transaction number: ", len(self._trans)
+
+    def _make_trans_stat(self):
         for trans_items in self._trans.itervalues():
-            itemset = []
-            for one_item in trans_items:
-                itemset.append(one_item)
-            trans_key = '\t'.join(itemset)
-            trans_stat[trans_key] += 1
-        print "transaction types: ", len(trans_stat)
-        self._trans_sorted = sorted(trans_stat.items(), key=operator.itemgetter(1), reverse=True)
-            
\ No newline at end of file
+            trans_key = self._code_dict.key_of(trans_items)
+            self._trans_stat[trans_key] += 1
+        self._trans.clear()
+
+    def _sort_trans_stat(self):
+        print "transaction types: ", len(self._trans_stat)
+        self._trans_sorted = sorted(self._trans_stat.items(), key=operator.itemgetter(1), reverse=True)
+            
@@ -1,109 +1,516 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
+import time
 import argparse
+import multiprocessing
 import operator
 import math
 import json
+import cPickle
+import hashlib
 import jieba
+import numpy as np
 import similarity
-from csv_parser import read_csv_with_headers
+from csv_parser import iter_csv_rows
+from CodeDictionary import CodeDictionary
+from trans_store import read_trans, is_trans_store
+from catalogue import load_snapshot, save_snapshot, catalogue_sources
 from misc import check_keys
-from collections import defaultdict
+from collections import defaultdict, Counter, deque
 
 class ReasonInferrer(object):
     """
         This class infers call reasons for call transactions
+        call_reason["similarity_engine"] picks how reasons are matched:
+          index  - inverted token index, exact simple_similarity scores (default)
+          sparse - similarity.SparseSimilarity over all reasons at once
+        The segmented name and best reason of every code are computed once;
+        with call_reason["cache_dir"] set they are kept on disk as well.
+        With a snapshot file, everything derived from the csv files is loaded
+        from it, and it is rebuilt when it is missing or stale.
     """
-    def __init__(self, trcode, call_reason, trans_file):
+    SIMILARITY_ENGINES = ('index', 'sparse')
+
+    def __init__(self, trcode, call_reason, trans_file, snapshot=""):
         check_keys(["file_name"], call_reason, "call_reason", basestring)
         check_keys(["call_reason_id_index", "call_reason_index"], call_reason, "call_reason", int)
+        if "similarity_engine" in call_reason:
+            check_keys(["similarity_engine"], call_reason, "call_reason", basestring)
+            if call_reason["similarity_engine"] not in self.SIMILARITY_ENGINES:
+                raise Exception('Similarity engine {0} is not one of {1}.'.format(call_reason["similarity_engine"], self.SIMILARITY_ENGINES))
+        if "cache_dir" in call_reason:
+            check_keys(["cache_dir"], call_reason, "call_reason", basestring)
         check_keys(["file_name"], trcode, "trcode", basestring)
         check_keys(["code_id_index", "code_type_index", "code_name_index", "code_reason_index"], trcode, "trcode", int)
-        if not os.path.isfile(trans_file):
+        # trans_file may be None when only single transactions are inferred
+        if trans_file is not None and not os.path.isfile(trans_file) and not is_trans_store(trans_file):
             raise Exception("{0} does not exist.".format(trans_file))
         self._call_reason_setting = call_reason
         self._trans_file = trans_file
+        self._snapshot = snapshot
         self._call_reasons = {}
+        self._call_reason_order = []
         self._call_reasons_segmented = {}
+        self._reason_rank = {}
+        self._reason_norms = {}
+        self._reason_postings = ({}, {})
+        self._similarity_engine = call_reason.get("similarity_engine", "index")
+        self._sparse_similarity = None
+        self._sparse_keys = None
+        self._top_k = 0
+        self._top_reasons = None
+        self._top_scores = None
+        self._vote_reasons = []
         self._trans = []
         self._trcode = trcode
+        self._code_dict = CodeDictionary()
         self._code_mapping = {}
-        self._load_code_mapping()
-        self._load_call_reason()
+        self._code_similarity = {}
+        snapshot_content = None
+        if snapshot != "":
+            snapshot_content = load_snapshot(snapshot, trcode, call_reason)
+        if snapshot_content is not None:
+            self._load_snapshot(snapshot_content)
+        else:
+            self._load_code_mapping()
+            self._load_call_reason()
+            self._load_code_similarity()
+            if snapshot != "":
+                self._save_snapshot(snapshot)
+
+    def _load_snapshot(self, snapshot):
+        for code, code_info in snapshot["codes"]:
+            self._code_mapping[self._code_dict.encode(code)] = list(code_info)
+        # Replaying the insertions in file order keeps the scan order of the
+        # reasons, which reason_index ranks refer to
+        for reason_id, reason in snapshot["call_reasons"]:
+            self._call_reason_order.append(reason_id)
+            self._call_reasons[reason_id] = reason
+            self._call_reasons_segmented[reason_id] = snapshot["segmented"][reason_id]
+        self._reason_rank, self._reason_norms, self._reason_postings = snapshot["reason_index"]
+        if self._similarity_engine == 'sparse':
+            self._build_sparse_similarity()
+        for code, result in snapshot["code_similarity"].iteritems():
+            self._code_similarity[self._code_dict.encode(code)] = result
+
+    def _save_snapshot(self, file_name):
+        save_snapshot(file_name, self._trcode, self._call_reason_setting, {
+            "codes": [(self._code_dict.decode(code_id), self._code_mapping[code_id]) for code_id in sorted(self._code_mapping)],
+            "call_reasons": [(reason_id, self._call_reasons[reason_id]) for reason_id in self._call_reason_order],
+            "segmented": self._call_reasons_segmented,
+            "reason_index": (self._reason_rank, self._reason_norms, self._reason_postings),
+            "code_similarity": dict((self._code_dict.decode(code_id), result) for code_id, result in self._code_similarity.iteritems())
+        })
 
     def _load_code_mapping(self):
-        _, lines = read_csv_with_headers(self._trcode['file_name'])
-        for line in lines:
-            code_id = line[self._trcode["code_id_index"]]
-            code_type = line[self._trcode["code_type_index"]].strip()
-            code_name = line[self._trcode["code_name_index"]].strip()
-            code_reason = line[self._trcode["code_reason_index"]].strip()
-            self._code_mapping[code_id] = [code_type, code_name, code_reason]
+        columns = [self._trcode[key] for key in ["code_id_index", "code_type_index", "code_name_index", "code_reason_index"]]
+        for code, code_type, code_name, code_reason in iter_csv_rows(self._trcode['file_name'], columns):
+            code_id = self._code_dict.encode(code)
+            self._code_mapping[code_id] = [code_type.strip(), code_name.strip(), code_reason.strip()]
 
     def _load_call_reason(self):
-        _, lines = read_csv_with_headers(self._call_reason_setting['file_name'])
-        id_index = self._call_reason_setting['call_reason_id_index']
-        reason_index = self._call_reason_setting['call_reason_index']
-        for line in lines:
-            self._call_reasons[line[id_index]] = line[reason_index].strip()
-            segmented = list(jieba.cut(line[reason_index].strip()))
-            self._call_reasons_segmented[line[id_index]] = segmented
+        columns = [self._call_reason_setting['call_reason_id_index'], self._call_reason_setting['call_reason_index']]
+        for reason_id, reason in iter_csv_rows(self._call_reason_setting['file_name'], columns):
+            self._call_reason_order.append(reason_id)
+            self._call_reasons[reason_id] = reason.strip()
+            segmented = list(jieba.cut(reason.strip()))
+            self._call_reasons_segmented[reason_id] = segmented
+        self._build_reason_index()
+
+    def _build_reason_index(self):
+        """Builds the token -> [(reason, token count)] postings used by
+           _get_best_similarity. Reasons ending with u'查询' are only compared
+           with transactions ending with it, without that token, so they go
+           into a separate index: _reason_postings[ends_with_query].
+           _reason_rank keeps the order a full scan visits the reasons in.
+        """
+        for rank, (key, vec) in enumerate(self._call_reasons_segmented.iteritems()):
+            self._reason_rank[key] = rank
+            ends_with_query = len(vec) > 0 and vec[-1] == u'查询'
+            bag = Counter(similarity.remove_stop_words(vec[:-1] if ends_with_query else vec))
+            self._reason_norms[key] = math.sqrt(sum(x*x for x in bag.itervalues()))
+            postings = self._reason_postings[ends_with_query]
+            for word, count in bag.iteritems():
+                postings.setdefault(word, []).append((key, count))
+        if self._similarity_engine == 'sparse':
+            self._build_sparse_similarity()
+
+    def _build_sparse_similarity(self):
+        self._sparse_keys, self._sparse_similarity = self._make_sparse_similarity()
+
+    def _read_cache(self, cache_file, sources):
+        """Returns code -> result of a code similarity cache, or None if it is
+           unreadable or was built from other sources
+        """
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = cPickle.load(f)
+        except (cPickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError, IndexError):
+            return None
+        if not isinstance(cached, dict) or cached.get("sources") != sources:
+            return None
+        return cached["codes"]
+
+    def _make_sparse_similarity(self):
+        """Encodes the reasons as SparseSimilarity matrices, indexed like
+           _reason_postings and with rows in scan order.
+        """
+        keys = ([], [])
+        bags = ([], [])
+        for key, vec in self._call_reasons_segmented.iteritems():
+            ends_with_query = len(vec) > 0 and vec[-1] == u'查询'
+            keys[ends_with_query].append(key)
+            bags[ends_with_query].append(vec[:-1] if ends_with_query else vec)
+        return keys, tuple(similarity.SparseSimilarity(b) for b in bags)
+
+    def _load_code_similarity(self):
+        """Fills _code_similarity: code id -> (segmented name, (similarity, reason)).
+           The cache file is keyed on the content and column settings of both
+           csv files; a cache that can not be read is rebuilt.
+        """
+        cache_file = None
+        cache_dir = self._call_reason_setting.get("cache_dir", "")
+        if cache_dir != "":
+            sources = catalogue_sources(self._trcode, self._call_reason_setting)
+            cache_file = os.path.join(cache_dir, 'code_similarity_{0}.pkl'.format(
+                hashlib.md5(repr(sorted(sources.items()))).hexdigest()))
+        if cache_file is not None and os.path.isfile(cache_file):
+            cached = self._read_cache(cache_file, sources)
+            if cached is not None:
+                for code, result in cached.iteritems():
+                    self._code_similarity[self._code_dict.encode(code)] = result
+                return
+        code_ids = []
+        segmented = []
+        for code_id, (_, chinese_part, _) in self._code_mapping.iteritems():
+            if chinese_part.decode('utf-8') not in ['', u'综合查询']:
+                code_ids.append(code_id)
+                segmented.append(list(jieba.cut(chinese_part)))
+        if self._sparse_similarity is not None:
+            best = self._get_best_similarities_sparse(segmented)
+        else:
+            best = [self._get_best_similarity(one_trans) for one_trans in segmented]
+        for code_id, one_trans, one_best in zip(code_ids, segmented, best):
+            self._code_similarity[code_id] = (one_trans, one_best)
+        if cache_file is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            cached = dict((self._code_dict.decode(code_id), result) for code_id, result in self._code_similarity.iteritems())
+            with open(cache_file + '.tmp', 'wb') as f:
+                cPickle.dump({"sources": sources, "codes": cached}, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(cache_file + '.tmp', cache_file)
 
     def find_reasons_for_one_trans(self, trans, min_len=0):
+        return self._find_reasons_for_code_ids(self._lookup_ids(trans), min_len, trans)
+
+    def _lookup_ids(self, codes):
+        """Returns the ids of codes, -1 for a code unknown to the catalogue.
+           No ids are assigned, so the dictionary does not grow with the codes
+           seen at inference time.
+        """
+        return [self._code_dict.get_id(code, -1) for code in codes]
+
+    def _find_reasons_for_code_ids(self, code_ids, min_len=0, codes=None):
+        full_trans_str, chinese_parts = self._describe_trans(code_ids, codes)
+        if min_len > 0 and len(chinese_parts) < min_len:
+            return full_trans_str, ''
+        return full_trans_str, self._arrange_trans_and_find_reason(chinese_parts)
+
+    def _describe_trans(self, code_ids, codes=None):
+        """Returns the readable transaction and the [code id, code reason, code type]
+           of its codes with a meaningful name. codes, when given, are the
+           codes of code_ids, needed for the unknown ones (id -1).
+        """
         chinese_parts =[]
         full_trans = []
-        for item in trans:
-            if item in self._code_mapping:
-                code_type, chinese_part, code_reason = self._code_mapping[item]
-                if chinese_part.decode('utf-8') not in ['', u'综合查询']:
-                    chinese_parts.append([list(jieba.cut(chinese_part)), code_reason, code_type])
+        for index, code_id in enumerate(code_ids):
+            item = codes[index] if codes is not None else self._code_dict.decode(code_id)
+            if code_id in self._code_mapping:
+                code_type, chinese_part, code_reason = self._code_mapping[code_id]
+                if code_id in self._code_similarity:
+                    chinese_parts.append([code_id, code_reason, code_type])
                 full_trans.append("{0}({1})".format(item, chinese_part))
             else:
                 full_trans.append("{0}()".format(item))
-        full_trans_str = '->'.join(full_trans)
-        if min_len > 0 and len(chinese_parts) < min_len:
-            return full_trans_str, ''
-        return full_trans_str, self._arrange_trans_and_find_reason(chinese_parts)
+        return '->'.join(full_trans), chinese_parts
+
+    def find_top_reasons(self, batch, k=3, threshold=0.5):
+        """Ranks the reasons of a batch of transactions, each a list of codes.
+           Every code votes for its k most similar reasons instead of the best
+           one only. Returns, per transaction, up to k (reason id, reason, score)
+           with a score above threshold.
+        """
+        parts_batch = [self._describe_trans(self._lookup_ids(trans), trans)[1] for trans in batch]
+        return [[(reason_id, self._call_reasons.get(reason_id, ''), score) for reason_id, score in ranked]
+            for ranked in self._rank_top_reasons(parts_batch, k, threshold)]
+
+    def _build_top_candidates(self, k):
+        """Fills _top_reasons/_top_scores, code id x k arrays of the indices in
+           _vote_reasons and the scores of the k best reasons of every code.
+           A code with a reason in trcode votes for that reason only, with 1.0.
+        """
+        self._vote_reasons = list(self._call_reasons_segmented)
+        reason_index = dict((reason_id, i) for i, reason_id in enumerate(self._vote_reasons))
+        self._top_reasons = np.full((len(self._code_dict), k), -1, dtype=np.int64)
+        self._top_scores = np.zeros((len(self._code_dict), k))
+        keys, engines = self._sparse_keys, self._sparse_similarity
+        if engines is None:
+            keys, engines = self._make_sparse_similarity()
+        code_ids = list(self._code_similarity)
+        for ends_with_query in (False, True):
+            branch = [code_id for code_id in code_ids if self._code_similarity[code_id][0][-1] == u'查询'] if ends_with_query \
+                else [code_id for code_id in code_ids if self._code_similarity[code_id][0][-1] != u'查询']
+            if len(branch) == 0 or len(engines[ends_with_query]) == 0:
+                continue
+            bags = [self._code_similarity[code_id][0] for code_id in branch]
+            scores = engines[ends_with_query].scores_batch([bag[:-1] for bag in bags] if ends_with_query else bags)
+            columns = np.array([reason_index[key] for key in keys[ends_with_query]], dtype=np.int64)
+            # A stable sort leaves ties in scan order
+            best = np.argsort(-scores, axis=1, kind='mergesort')[:, :k]
+            for row, code_id in enumerate(branch):
+                row_scores = scores[row, best[row]]
+                positive = row_scores > 0
+                self._top_reasons[code_id, :positive.sum()] = columns[best[row][positive]]
+                self._top_scores[code_id, :positive.sum()] = row_scores[positive]
+        for code_id in code_ids:
+            code_reason = self._code_mapping[code_id][2]
+            if code_reason != '':
+                if code_reason not in reason_index:
+                    reason_index[code_reason] = len(self._vote_reasons)
+                    self._vote_reasons.append(code_reason)
+                self._top_reasons[code_id] = -1
+                self._top_scores[code_id] = 0.0
+                self._top_reasons[code_id, 0] = reason_index[code_reason]
+                self._top_scores[code_id, 0] = 1.0
+        self._top_k = k
+
+    def _vote_elements(self, chinese_parts, elements):
+        """Appends (code id, decay exponent) of the codes voting for a transaction,
+           segmented on action codes the way _arrange_trans_and_find_reason does
+        """
+        one_seg = []
+        found_action = False
+        for chinese_part in chinese_parts:
+            one_seg.append(chinese_part[0])
+            if chinese_part[-1] == '2':
+                found_action = True
+                self._segment_elements(one_seg, True, elements)
+                one_seg = []
+        if len(one_seg) > 0 and not found_action:
+            self._segment_elements(one_seg, False, elements)
+
+    def _segment_elements(self, one_seg, has_action, elements):
+        # A matching action code decides its segment alone, see _find_reason
+        if has_action and self._top_scores[one_seg[-1], 0] > 0:
+            elements.append((one_seg[-1], 0))
+            return
+        for i, code_id in enumerate(one_seg):
+            elements.append((code_id, len(one_seg) - i - 1))
+
+    def _rank_top_reasons(self, parts_batch, k, threshold):
+        """Decay-weighted voting of a batch as array operations, returns the
+           ranked [(reason id, score)] of every transaction
+        """
+        if self._top_k != k:
+            self._build_top_candidates(k)
+        trans_index = []
+        elements = []
+        for i, chinese_parts in enumerate(parts_batch):
+            start = len(elements)
+            self._vote_elements(chinese_parts, elements)
+            trans_index.extend([i] * (len(elements) - start))
+        reason_number = len(self._vote_reasons)
+        votes = np.zeros(len(parts_batch) * reason_number)
+        if len(elements) > 0:
+            code_ids, exponents = np.array(elements, dtype=np.int64).T
+            weights = self._top_scores[code_ids] * np.power(0.7, exponents)[:, np.newaxis]
+            reasons = self._top_reasons[code_ids]
+            rows = np.repeat(np.array(trans_index, dtype=np.int64), k).reshape(-1, k)
+            valid = reasons >= 0
+            votes = np.bincount(rows[valid] * reason_number + reasons[valid], weights[valid],
+                minlength=len(parts_batch) * reason_number)
+        votes = votes.reshape(len(parts_batch), reason_number)
+        results = []
+        for row in votes:
+            candidates = np.flatnonzero(row > threshold)
+            ranked = candidates[np.argsort(-row[candidates], kind='mergesort')][:k]
+            results.append([(self._vote_reasons[r], row[r]) for r in ranked])
+        return results
 
     def find_reasons(self, start=0, end=0, min_len=0):
         trans_count = 0
         valid_trans_count = 0
         with open('res.csv', 'w') as fout:
-            with open(self._trans_file, 'r') as f:
-                for line in f:
-                    trans_count += 1
-                    if trans_count < start+1:
-                        continue
-                    if end != 0 and trans_count > end:
-                        return
-                    items = line.split('\t')
-                    full_trans_str, reason_str = self.find_reasons_for_one_trans(items[:-1], min_len)
-                    if reason_str == '':
-                        continue
-                    print full_trans_str, items[-1].strip(), '\t', reason_str, '\n'
-                    fout.write('{0}\t{1}\t{2}\n'.format(full_trans_str, items[-1].strip(), reason_str))
-                    valid_trans_count += 1
-                    if valid_trans_count % 10 == 0:
-                        raw_input('Press any key to get another 10 results...')
+            for code_ids, freq in read_trans(self._trans_file, self._code_dict):
+                trans_count += 1
+                if trans_count < start+1:
+                    continue
+                if end != 0 and trans_count > end:
+                    return
+                full_trans_str, reason_str = self._find_reasons_for_code_ids(code_ids, min_len)
+                if reason_str == '':
+                    continue
+                print full_trans_str, freq, '\t', reason_str, '\n'
+                fout.write('{0}\t{1}\t{2}\n'.format(full_trans_str, freq, reason_str))
+                valid_trans_count += 1
+                if valid_trans_count % 10 == 0:
+                    raw_input('Press any key to get another 10 results...')
+
+    def find_reasons_batch(self, output_file, workers=1, chunk_size=1000, start=0, end=0, min_len=0, progress=None, top_k=0):
+        """Non-interactive find_reasons. Transactions are inferred in chunks,
+           by a pool of workers each holding its own ReasonInferrer when
+           workers > 1, and written to output_file in input order.
+           progress, if given, is called after every chunk with
+           (processed transactions, written results, elapsed seconds).
+           With top_k > 0 the top_k reasons of find_top_reasons are written.
+        """
+        start_time = time.time()
+        trans_count = 0
+        valid_trans_count = 0
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, _init_worker,
+                (self._trcode, self._call_reason_setting, self._trans_file, self._snapshot))
+        try:
+            with open(output_file, 'w') as fout:
+                pending = deque()
+                chunks = self._read_chunks(chunk_size, start, end)
+                while True:
+                    # Keep a bounded number of chunks in flight, results are
+                    # taken back in submission order
+                    while pool is not None and len(pending) < 2 * workers:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        pending.append(pool.apply_async(_infer_chunk, (chunk, min_len, top_k)))
+                    if pool is not None:
+                        if len(pending) == 0:
+                            break
+                        results = pending.popleft().get()
+                    else:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        results = self._infer_chunk(chunk, min_len, top_k)
+                    for full_trans_str, freq, reason_str in results:
+                        trans_count += 1
+                        if reason_str == '':
+                            continue
+                        fout.write('{0}\t{1}\t{2}\n'.format(full_trans_str, freq, reason_str))
+                        valid_trans_count += 1
+                    if progress is not None:
+                        progress(trans_count, valid_trans_count, time.time() - start_time)
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return trans_count, valid_trans_count
+
+    def _read_chunks(self, chunk_size, start, end):
+        """Generates lists of (codes, freq) of the transactions in (start, end]"""
+        trans_count = 0
+        chunk = []
+        for code_ids, freq in read_trans(self._trans_file, self._code_dict):
+            trans_count += 1
+            if trans_count < start+1:
+                continue
+            if end != 0 and trans_count > end:
+                break
+            chunk.append((self._code_dict.decode_seq(code_ids), freq))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def _infer_chunk(self, chunk, min_len, top_k=0):
+        results = []
+        if top_k > 0:
+            described = [self._describe_trans(self._lookup_ids(codes), codes) for codes, _ in chunk]
+            ranked_batch = self._rank_top_reasons([chinese_parts for _, chinese_parts in described], top_k, 0.5)
+            for (_, freq), (full_trans_str, chinese_parts), ranked in zip(chunk, described, ranked_batch):
+                reason_str = ''
+                if min_len == 0 or len(chinese_parts) >= min_len:
+                    reason_str = ', '.join(['{0}-{1}({2})'.format(key, self._call_reasons.get(key, ''), value) for key, value in ranked])
+                results.append((full_trans_str, freq, reason_str))
+            return results
+        for codes, freq in chunk:
+            full_trans_str, reason_str = self.find_reasons_for_one_trans(codes, min_len)
+            results.append((full_trans_str, freq, reason_str))
+        return results
 
     def _get_best_similarity(self, one_trans):
+        """Returns the most similar reason, the first one in scan order on ties.
+           Only reasons sharing a token with one_trans can score above 0, they
+           are taken from the postings and checked in decreasing order of their
+           estimated cosine, stopping once the estimate falls below the best.
+        """
+        if self._sparse_similarity is not None:
+            return self._get_best_similarities_sparse([one_trans])[0]
         highest_similarity = 0.0
         best_reason_index = 0
-        for key, vec in self._call_reasons_segmented.iteritems():
-            sim = 0.0
-            if one_trans[-1] != u'查询' and vec[-1] != u'查询':
-                sim = similarity.simple_similarity(vec, one_trans)
-            elif one_trans[-1] == u'查询' and vec[-1] == u'查询':
+        ends_with_query = one_trans[-1] == u'查询'
+        bag = Counter(similarity.remove_stop_words(one_trans[:-1] if ends_with_query else one_trans))
+        postings = self._reason_postings[ends_with_query]
+        dots = defaultdict(int)
+        for word, count in bag.iteritems():
+            for key, reason_count in postings.get(word, ()):
+                dots[key] += count * reason_count
+        if len(dots) == 0:
+            return highest_similarity, best_reason_index
+        norm = math.sqrt(sum(x*x for x in bag.itervalues()))
+        candidates = sorted((-dot / (norm * self._reason_norms[key]), self._reason_rank[key], key)
+            for key, dot in dots.iteritems())
+        best_rank = None
+        for estimate, rank, key in candidates:
+            # The estimate equals the cosine up to rounding
+            if -estimate < highest_similarity - 1e-9:
+                break
+            vec = self._call_reasons_segmented[key]
+            if ends_with_query:
                 sim = similarity.simple_similarity(vec[:-1], one_trans[:-1])
-            if sim > highest_similarity:
+            else:
+                sim = similarity.simple_similarity(vec, one_trans)
+            if sim > highest_similarity or (sim == highest_similarity and rank < best_rank):
                 highest_similarity = sim
                 best_reason_index = key
+                best_rank = rank
         return highest_similarity, best_reason_index
 
+    def _get_best_similarities_sparse(self, batch):
+        """Scores a batch of segmented names with one product per index.
+           Ties within rounding go to the first reason in scan order and the
+           returned score is recomputed with simple_similarity.
+        """
+        results = [(0.0, 0)] * len(batch)
+        for ends_with_query in (False, True):
+            positions = [i for i, one_trans in enumerate(batch) if (one_trans[-1] == u'查询') == ends_with_query]
+            engine = self._sparse_similarity[ends_with_query]
+            if len(positions) == 0 or len(engine) == 0:
+                continue
+            if ends_with_query:
+                scores = engine.scores_batch([batch[i][:-1] for i in positions])
+            else:
+                scores = engine.scores_batch([batch[i] for i in positions])
+            for row, i in enumerate(positions):
+                highest = scores[row].max()
+                if highest <= 0:
+                    continue
+                key = self._sparse_keys[ends_with_query][np.flatnonzero(scores[row] >= highest - 1e-9)[0]]
+                vec = self._call_reasons_segmented[key]
+                if ends_with_query:
+                    results[i] = (similarity.simple_similarity(vec[:-1], batch[i][:-1]), key)
+                else:
+                    results[i] = (similarity.simple_similarity(vec, batch[i]), key)
+        return results
+
     def _arrange_trans_and_find_reason(self, chinese_parts, threshold=0.5):
         reason_str = "0-综合查询/未知(0.0)"
         if len(chinese_parts) == 0:
-            return reason_id+'-'+reason_str, vote_score
+            return reason_str
         reasons = defaultdict(float)
         one_seg = []
         found_action = False
@@ -127,12 +534,13 @@ class ReasonInferrer(object):
 
 
     def _find_reason(self, chinese_parts, has_action, use_mapping=True):
+        """chinese_parts holds [code id, code reason] of the codes of a segment"""
         reason_id = 0
         reason_str = "综合查询/未知"
         vote_score = 0.0
         votes = defaultdict(float)
         for i in reversed(range(len(chinese_parts))):
-            highest_similarity, best_reason_index = self._get_best_similarity(chinese_parts[i][0])
+            highest_similarity, best_reason_index = self._code_similarity[chinese_parts[i][0]][1]
             if use_mapping and chinese_parts[i][1] != '':
                 best_reason_index = chinese_parts[i][1]
                 highest_similarity = 1.0
@@ -142,20 +550,48 @@ class ReasonInferrer(object):
                 break
         return votes
 
+# ReasonInferrer of a batch worker process, loaded once by _init_worker
+_worker_inferrer = None
+
+def _init_worker(trcode, call_reason, trans_file, snapshot):
+    global _worker_inferrer
+    _worker_inferrer = ReasonInferrer(trcode, call_reason, trans_file, snapshot)
+
+def _infer_chunk(chunk, min_len, top_k):
+    return _worker_inferrer._infer_chunk(chunk, min_len, top_k)
+
+def _report_progress(trans_count, valid_trans_count, elapsed):
+    sys.stderr.write('{0} transactions, {1} results, {2:.0f} trans/s\r'.format(
+        trans_count, valid_trans_count, trans_count / max(elapsed, 1e-6)))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--setting', default='settings.json', help='setting of ReasonInferrer, default settings.json')
     parser.add_argument('-t', '--trans', default='', help='One transaction to be processed')
     parser.add_argument('-d', '--delimiter', default=',', help='delimiter of trans')
+    parser.add_argument('-b', '--batch', action='store_true', help='process all transactions without prompting')
+    parser.add_argument('-o', '--output', default='res.csv', help='output file of batch mode, default res.csv')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='worker processes of batch mode, default 1')
+    parser.add_argument('-k', '--top-k', type=int, default=0, help='in batch mode, cut each row to the top k reasons if k > 0, default 0 keeps the original output of every reason above the threshold')
+    parser.add_argument('-c', '--compile', action='store_true', help='only (re)build the catalogue_snapshot of the setting')
     args = parser.parse_args()
 
     with open(args.setting, 'r') as f:
         setting = json.load(f)
-        reason_inferrer = ReasonInferrer(setting['trcode'], setting['call_reason'], setting['trans_stat_output'])
+        snapshot = setting.get('catalogue_snapshot', '')
+        if args.compile:
+            if snapshot == '':
+                raise Exception('catalogue_snapshot is not set in {0}.'.format(args.setting))
+            ReasonInferrer(setting['trcode'], setting['call_reason'], None, snapshot)
+            return
+        reason_inferrer = ReasonInferrer(setting['trcode'], setting['call_reason'], setting['trans_stat_output'], snapshot)
         if args.trans != '':
             items = args.trans.split(args.delimiter)
             full_trans_str, reason_str = reason_inferrer.find_reasons_for_one_trans(items)
             print full_trans_str,'\t', reason_str
+        elif args.batch:
+            reason_inferrer.find_reasons_batch(args.output, workers=args.workers, min_len=5, progress=_report_progress, top_k=args.top_k)
+            sys.stderr.write('\n')
         else:
             reason_inferrer.find_reasons(start=0, end=0, min_len=5)
 
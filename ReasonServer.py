@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from ReasonInferrer import ReasonInferrer
+
+
+class ReasonServer(object):
+    """
+        This class keeps a ReasonInferrer warm behind a localhost HTTP server.
+        POST /infer takes {"trans": [code, ...]} or {"batch": [[code, ...], ...]}
+        with an optional "min_len", GET /health reports the catalogue version.
+        The trcode and call_reason files are watched, on change a new
+        ReasonInferrer is built aside and swapped in; requests in flight
+        finish on the one they started with.
+    """
+    def __init__(self, setting, host='127.0.0.1', port=8765, reload_interval=5.0):
+        self._trcode = setting['trcode']
+        self._call_reason = setting['call_reason']
+        self._snapshot = setting.get('catalogue_snapshot', '')
+        self._reload_interval = reload_interval
+        self._swap_lock = threading.Lock()
+        self._version = 0
+        self._sources = self._source_stats()
+        self._inferrer = None
+        self._load()
+        self._httpd = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self._httpd.reason_server = self
+        self._stopped = threading.Event()
+
+    def _source_stats(self):
+        stats = []
+        for file_name in [self._trcode['file_name'], self._call_reason['file_name']]:
+            st = os.stat(file_name)
+            stats.append((st.st_mtime, st.st_size))
+        return stats
+
+    def _load(self):
+        inferrer = ReasonInferrer(self._trcode, self._call_reason, None, self._snapshot)
+        with self._swap_lock:
+            self._inferrer = inferrer
+            self._version += 1
+
+    def _watch(self):
+        while not self._stopped.wait(self._reload_interval):
+            try:
+                sources = self._source_stats()
+                if sources == self._sources:
+                    continue
+                self._sources = sources
+                self._load()
+                sys.stderr.write('Catalogue reloaded, version {0}\n'.format(self._version))
+            except Exception as e:
+                # Keep serving with the previous catalogue
+                sys.stderr.write('Catalogue reload failed: {0}\n'.format(e))
+
+    def infer(self, request):
+        with self._swap_lock:
+            inferrer, version = self._inferrer, self._version
+        min_len = request.get('min_len', 0)
+        if not isinstance(min_len, int):
+            raise ValueError('min_len must be an integer')
+        results = []
+        if 'batch' in request:
+            if not isinstance(request['batch'], list):
+                raise ValueError('batch must be a list of transactions')
+            batch = [_codes_of(trans) for trans in request['batch']]
+        else:
+            batch = [_codes_of(request['trans'])]
+        # ReasonInferrer only reads its catalogue when inferring, no lock is needed
+        for trans in batch:
+            full_trans_str, reason_str = inferrer.find_reasons_for_one_trans(trans, min_len)
+            results.append({"trans": full_trans_str, "reasons": reason_str})
+        if 'batch' in request:
+            return {"results": results, "version": version}
+        results[0]["version"] = version
+        return results[0]
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def address(self):
+        return self._httpd.server_address
+
+    def serve_forever(self):
+        watcher = threading.Thread(target=self._watch)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        self._stopped.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def _codes_of(trans):
+    """Returns the codes of a transaction of a request as utf-8 strings"""
+    if not isinstance(trans, list) or not all(isinstance(code, basestring) for code in trans):
+        raise ValueError('a transaction must be a list of code strings')
+    return [code.encode('utf-8') if isinstance(code, unicode) else code for code in trans]
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._reply(404, {"error": "not found"})
+            return
+        self._reply(200, {"status": "ok", "version": self.server.reason_server.version})
+
+    def do_POST(self):
+        if self.path != '/infer':
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length))
+            if 'trans' not in request and 'batch' not in request:
+                raise ValueError('trans or batch is required')
+            response = self.server.reason_server.infer(request)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+            return
+        self._reply(200, response)
+
+    def _reply(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--setting', default='settings.json', help='setting of ReasonInferrer, default settings.json')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on, default 127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8765, help='port to listen on, default 8765')
+    parser.add_argument('-r', '--reload-interval', type=float, default=5.0, help='seconds between catalogue checks, default 5')
+    args = parser.parse_args()
+    with open(args.setting, 'r') as f:
+        setting = json.load(f)
+    server = ReasonServer(setting, args.host, args.port, args.reload_interval)
+    sys.stderr.write('Serving on {0}:{1}\n'.format(*server.address))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,35 @@
 import os
 import json
 from LogParser import LogParser
+from CodeDictionary import CodeDictionary
 from ReasonInferrer import ReasonInferrer
+from trans_store import is_trans_store, write_trans_store
 
 setting_file = 'settings.json'
 
 def main():
     with open(setting_file, 'r') as f:
         setting = json.load(f)
-        if not os.path.isfile(setting['trans_stat_output']):
-            log_parser = LogParser(setting['service_log'], setting["filter_str"])
-            log_parser.process_and_store(setting['trans_stat_output'])
-        reason_inferrer = ReasonInferrer(setting['trcode'], setting['call_reason'], setting['trans_stat_output'])
+        incremental = setting.get('incremental')
+        if incremental is not None:
+            # service_log holds only the newly received days
+            code_dict = CodeDictionary(setting['trcode'])
+            log_parser = LogParser(setting['service_log'], setting["filter_str"], code_dict)
+            log_parser.update_incremental(setting['trans_stat_output'], incremental['state_dir'],
+                incremental.get('window_days', 0), setting.get('trans_stat_binary', ''))
+        elif not os.path.isfile(setting['trans_stat_output']):
+            code_dict = CodeDictionary(setting['trcode'])
+            log_parser = LogParser(setting['service_log'], setting["filter_str"], code_dict)
+            log_parser.process_and_store(setting['trans_stat_output'], setting.get('trans_stat_binary', ''))
+        trans_file = setting['trans_stat_output']
+        binary_prefix = setting.get('trans_stat_binary', '')
+        if binary_prefix != '':
+            if not is_trans_store(binary_prefix):
+                # trans_stat_output was parsed before trans_stat_binary was set
+                code_dict = CodeDictionary(setting['trcode'])
+                write_trans_store(binary_prefix, code_dict.read_trans_file(trans_file), code_dict.codes)
+            trans_file = binary_prefix
+        reason_inferrer = ReasonInferrer(setting['trcode'], setting['call_reason'], trans_file, setting.get('catalogue_snapshot', ''))
         reason_inferrer.find_reasons(start=0, end=0, min_len=5)
 
 if __name__ == '__main__':
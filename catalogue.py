@@ -0,0 +1,51 @@
+"""
+Versioned binary snapshot of the trcode and call_reason catalogues.
+
+A snapshot is a pickled dict holding
+    version        VERSION of the layout
+    sources        digest and column settings of both csv files
+    codes          [(code, [code_type, code_name, code_reason])] in file order
+    call_reasons   [(reason_id, reason)] in file order
+    segmented      reason_id -> segmented reason
+    reason_index   (rank, norms, postings) of ReasonInferrer._build_reason_index
+    code_similarity code -> (segmented name, (similarity, reason_id))
+It is stale, and ignored, once either csv file or its settings change.
+"""
+import os
+import cPickle
+from misc import file_digest
+
+VERSION = 1
+
+_TRCODE_KEYS = ["code_id_index", "code_type_index", "code_name_index", "code_reason_index"]
+_CALL_REASON_KEYS = ["call_reason_id_index", "call_reason_index"]
+
+
+def catalogue_sources(trcode, call_reason):
+    """Digest and column settings of both csv files, what derived data depends on"""
+    return {
+        "trcode": (file_digest(trcode['file_name']), [trcode[key] for key in _TRCODE_KEYS]),
+        "call_reason": (file_digest(call_reason['file_name']), [call_reason[key] for key in _CALL_REASON_KEYS])
+    }
+
+def load_snapshot(file_name, trcode, call_reason):
+    """Returns the snapshot in file_name, or None if it is missing or stale"""
+    if not os.path.isfile(file_name):
+        return None
+    try:
+        with open(file_name, 'rb') as f:
+            snapshot = cPickle.load(f)
+    except (cPickle.UnpicklingError, EOFError, ValueError):
+        return None
+    if snapshot.get("version") != VERSION or snapshot.get("sources") != catalogue_sources(trcode, call_reason):
+        return None
+    return snapshot
+
+def save_snapshot(file_name, trcode, call_reason, content):
+    """Writes content, a dict of the fields above, as the snapshot of the catalogues"""
+    snapshot = dict(content)
+    snapshot["version"] = VERSION
+    snapshot["sources"] = catalogue_sources(trcode, call_reason)
+    with open(file_name + '.tmp', 'wb') as f:
+        cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(file_name + '.tmp', file_name)
@@ -6,17 +6,44 @@ def remove_quote(item):
     else:
         return item
 
-def read_csv_with_headers(filename):
+def read_csv_headers(filename):
+    """Returns the header name -> column index map of a csv file"""
     attribute_map = {}
-    lines = []
     with open(filename, 'rU') as f:
-        reader = csv.reader(f)
-        headers = reader.next()
-        attribute_index = 0
-        for item in headers:
+        headers = csv.reader(f).next()
+        for attribute_index, item in enumerate(headers):
             attribute_map[remove_quote(item)] = attribute_index
-            attribute_index += 1
-        for line in reader:
-            clean_line = [remove_quote(item) for item in line]
-            lines.append(clean_line)
-    return attribute_map, lines
\ No newline at end of file
+    return attribute_map
+
+def iter_csv_rows(filename, columns=None, batch_size=0, headers=True, strip_quotes=True):
+    """Generates the rows of a csv file, the header line skipped when headers
+       is set, one list of cells at a time or, with batch_size > 0, lists of
+       up to batch_size rows. With columns, a list of column indices, a row
+       only holds those cells, in that order. With strip_quotes unset, cells
+       are left as csv.reader returns them.
+    """
+    with open(filename, 'rU') as f:
+        reader = csv.reader(f)
+        if headers:
+            next(reader, None)
+        if not strip_quotes:
+            rows = reader if columns is None else ([line[index] for index in columns] for line in reader)
+        elif columns is None:
+            rows = ([remove_quote(item) for item in line] for line in reader)
+        else:
+            rows = ([remove_quote(line[index]) for index in columns] for line in reader)
+        if batch_size <= 0:
+            for row in rows:
+                yield row
+            return
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def read_csv_with_headers(filename):
+    return read_csv_headers(filename), list(iter_csv_rows(filename))
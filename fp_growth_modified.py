@@ -9,19 +9,34 @@ Basic usage of the module is very simple:
     >>> find_frequent_itemsets(transactions, minimum_support)
 """
 
-from collections import defaultdict, namedtuple
+from array import array
+from collections import defaultdict, namedtuple, deque, OrderedDict
 from itertools import imap
-from scipy import stats
+from csv_parser import iter_csv_rows
 import numpy as np
+from trans_store import TransStore, is_trans_store
+import os
+import heapq
+import shutil
+import tempfile
+import cPickle
+import multiprocessing
 import time
 
+MODES = ('all', 'closed', 'maximal')
 
-def find_frequent_itemsets(transactions, minimum_support, minimum_confidence, include_support_n_confidence=False):
+def find_frequent_itemsets(transactions, minimum_support, minimum_confidence, include_support_n_confidence=False,
+    tree_factory=None, workers=1, mode='all', top_k=0, top_k_key='chi_square', weighted=False,
+    partition_dir=None):
     """
     Find frequent itemsets in the given transactions using FP-growth. This
     function returns a generator instead of an eagerly-populated list of items.
 
-    The `transactions` parameter can be any iterable of iterables of items.
+    The `transactions` parameter can be any iterable of iterables of items,
+    or the path of a CSV file of them. A path or a re-iterable collection,
+    such as a list, is scanned twice instead of being copied into memory.
+    With `weighted` set, transactions are (itemset, count, pos_count) records
+    instead, see weighted_transactions, and each is inserted only once.
     `minimum_support` should be an integer specifying the minimum number of
     occurrences of an itemset for it to be accepted. `minimum_confidence` should
     be a float value between 0 and 1, indicating the minimum confidence of
@@ -32,33 +47,64 @@ def find_frequent_itemsets(transactions, minimum_support, minimum_confidence, in
 
     If `include_support_n_confidence` is true, yield (itemset, support, pos_count, 
     confidence) instead of just the itemsets.
+
+    `tree_factory` builds the master and conditional trees, FPTree by default;
+    pass CompactFPTree for trees too large for one object per node.
+
+    With `workers` > 1 the conditional trees of the top-level items are mined
+    in a pool of processes; itemsets then come out grouped by top-level item
+    rather than in the serial order.
+
+    `mode` is one of MODES: 'all' frequent itemsets, or only the 'closed' (no
+    superset with the same support) or 'maximal' (no frequent superset) ones.
+    These two are collected in full before the first one is generated. The
+    search skips the subtrees they cannot come from: find_closed merges the
+    items as frequent as their suffix and find_maximal the conditional trees
+    whose items are covered by a maximal itemset already found.
+    With `top_k` > 0 only the `top_k` itemsets with the largest `top_k_key`,
+    one of TOP_K_KEYS, are generated, best first; once that many are found,
+    suffixes whose supersets cannot beat the k-th are not extended.
+
+    With `partition_dir` set no master tree is built: after counting the
+    supports, transactions are projected into one file per frequent item
+    under that directory, and each is mined on its own, see
+    find_in_partitions. This needs a path or a re-iterable collection.
     """
+    if tree_factory is None:
+        tree_factory = FPTree
+    if mode not in MODES:
+        raise ValueError('mode {0} is not one of {1}'.format(mode, MODES))
+    if top_k_key not in TOP_K_KEYS:
+        raise ValueError('top_k_key {0} is not one of {1}'.format(top_k_key, sorted(TOP_K_KEYS)))
     items = defaultdict(lambda: 0) # mapping from items to their supports
+    item_pos_counts = defaultdict(lambda: 0)
     processed_transactions = []
     positive_no = 0
     negative_no = 0
 
-    # Labeled_Trans for transaction with labels
-    Labeled_Trans = namedtuple('Labeled_Trans', 'trans label')
+    # Weighted_Trans for transaction with count and pos_count
+    Weighted_Trans = namedtuple('Weighted_Trans', 'trans count pos_count')
+    read = weighted_transactions if weighted else labeled_transactions
+
+    # A CSV path or a re-iterable collection is read twice: to count the
+    # supports, then to fill the tree. A one-shot iterator is kept in memory
+    # between the two.
+    two_pass = isinstance(transactions, basestring) or iter(transactions) is not transactions
+    if partition_dir is not None and not two_pass:
+        raise ValueError('partition_dir needs a path or a re-iterable collection of transactions')
 
     # Load the passed-in transactions and count the support that individual
     # items have.
-    for transaction in transactions:
-        # Assert when transaction lenth <= 2 since a transaction with id and label should has at least lenth of 3
-        assert len(transaction) > 2, "Transaction %s has no more than 2 items" % ','.join(transaction)
-        # Remove id
-        transaction.pop(0)
-        # Get label
-        label = True if transaction.pop(-1) == 'T' else False
-        if label:
-            positive_no += 1
-        else:
-            negative_no += 1
-        processed = []
-        for item in transaction:
-            items[item] += 1
-            processed.append(item)
-        processed_transactions.append(Labeled_Trans(processed, label))
+    for trans, count, pos_count in read(transactions):
+        positive_no += pos_count
+        negative_no += count - pos_count
+        for item in trans:
+            items[item] += count
+        if partition_dir is not None:
+            for item in trans:
+                item_pos_counts[item] += pos_count
+        elif not two_pass:
+            processed_transactions.append(Weighted_Trans(trans, count, pos_count))
 
     # Remove infrequent items from the item support dictionary.
     items = dict((item, support) for item, support in items.iteritems()
@@ -75,53 +121,625 @@ def find_frequent_itemsets(transactions, minimum_support, minimum_confidence, in
     def clean_transaction(transaction):
         cleaned_transaction = filter(lambda v: v in order_items, transaction.trans)
         cleaned_transaction.sort(key=lambda v: order_items[v], reverse=False)
-        return Labeled_Trans(cleaned_transaction, transaction.label)
-
-    master = FPTree()
-    for transaction in imap(clean_transaction, processed_transactions):
-        #print transaction.trans, transaction.label
-        master.add(transaction.trans, 1, (1 if transaction.label else 0))
-
-    def find_with_suffix(tree, suffix):
-        if tree.no_branch:
-            # Pruning: directly output in this case
-            suffix_set = tree.item_order
-            remaining_set = suffix_set
-            last_support = 0
-            for item in reversed(suffix_set):
-                _nodes = list(tree.nodes(item))
-                support, pos_count = sum(n.count for n in _nodes), sum(n.pos_count for n in _nodes)
-                confidence = 0 if support == 0 else float(pos_count) / support
-                chi_square = stats.chisquare(np.array([pos_count, support - pos_count]), np.array([positive_no, negative_no]))[0]
-                if last_support != 0 and last_support == support:
-                    continue
-                if confidence >= minimum_confidence:
-                    yield ((remaining_set + suffix), support, pos_count, confidence, chi_square) if include_support_n_confidence else remaining_set
-                last_support = support
+        return Weighted_Trans(cleaned_transaction, transaction.count, transaction.pos_count)
+
+    # Closed and maximal itemsets are judged against all frequent itemsets,
+    # so confidence is only applied once they are known.
+    filtered = mode != 'all'
+    mining = Mining(minimum_support, 0 if filtered else minimum_confidence,
+        include_support_n_confidence or filtered or top_k > 0, positive_no, negative_no, tree_factory, mode,
+        order_items)
+
+    pooled = False
+    if partition_dir is not None:
+        pooled = workers > 1
+        stats = dict((item, (support, item_pos_counts[item])) for item, support in items.iteritems())
+        cleaned = imap(clean_transaction, (Weighted_Trans(*transaction) for transaction in read(transactions)))
+        results = find_in_partitions(cleaned, res, stats, mining, partition_dir, workers)
+    else:
+        if two_pass:
+            processed_transactions = (Weighted_Trans(*transaction) for transaction in read(transactions))
+        master = tree_factory()
+        for transaction in imap(clean_transaction, processed_transactions):
+            master.add(transaction.trans, transaction.count, transaction.pos_count)
+
+        if workers > 1 and not master.no_branch:
+            pooled = True
+            results = find_in_parallel(master, mining, workers)
+        elif mode == 'closed':
+            results = find_closed(master, [], positive_no + negative_no, positive_no, mining)
+        elif mode == 'maximal':
+            results = find_maximal(master, [], positive_no + negative_no, positive_no, mining)
+        else:
+            # Search for frequent itemsets, and yield the results we find.
+            results = find_with_suffix(master, [], mining)
+    if not filtered and top_k == 0:
+        for itemset in results:
+            yield itemset
+        return
+
+    if mode == 'closed':
+        results = closed_itemsets(results, minimum_confidence, mining, pooled)
+    elif mode == 'maximal':
+        results = maximal_itemsets(results, minimum_confidence, mining, pooled)
+    if top_k > 0:
+        results = top_k_itemsets(results, top_k, top_k_key, mining if mode == 'all' else None)
+    for itemset, support, pos_count, confidence, chi_square in results:
+        yield (itemset, support, pos_count, confidence, chi_square) if include_support_n_confidence else itemset
+
+def labeled_transactions(transactions):
+    """
+    Generates (items, 1, 1 or 0) of transactions, rows of an id, the items
+    and a T/F label, given as an iterable or the path of a CSV file. The rows
+    themselves are left untouched.
+    """
+    if isinstance(transactions, basestring):
+        for transaction in labeled_transactions(iter_csv_rows(transactions, headers=False, strip_quotes=False)):
+            yield transaction
+        return
+    for transaction in transactions:
+        # Assert when transaction lenth <= 2 since a transaction with id and label should has at least lenth of 3
+        assert len(transaction) > 2, "Transaction %s has no more than 2 items" % ','.join(transaction)
+        # Remove id, get label
+        yield transaction[1:-1], 1, (1 if transaction[-1] == 'T' else 0)
+
+def weighted_transactions(transactions):
+    """
+    Generates (items, count, pos_count) of transactions, given as an
+    iterable of such records, a binary transaction store with pos_counts, or
+    a trans_stat file with a pos_count column: items, count and pos_count
+    separated by tabs.
+    """
+    if isinstance(transactions, basestring):
+        if is_trans_store(transactions):
+            store = TransStore(transactions)
+            codes = np.array(store.codes, dtype=object)
+            for code_ids, count, pos_count in store.records():
+                yield codes[code_ids].tolist(), int(count), int(pos_count)
+            return
+        with open(transactions, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                assert len(fields) > 2, "Line %s has no items" % line
+                yield fields[:-2], int(fields[-2]), int(fields[-1])
+        return
+    for trans, count, pos_count in transactions:
+        yield list(trans), count, pos_count
+
+class Mining(object):
+    """
+    Parameters of a mining run, shared by all levels of the recursion.
+    minimum_support may be raised and top_k_floor set while mining, see
+    top_k_itemsets. item_rank maps the frequent items to their position in
+    the item order. found holds the itemsets generated so far: an
+    ItemsetIndex of the closed ones, keyed on support and pos_count, or an
+    MFI-tree of the maximal ones, their items along item_rank.
+    """
+
+    def __init__(self, minimum_support, minimum_confidence, include_support_n_confidence,
+        positive_no, negative_no, tree_factory, mode='all', item_rank=None):
+        self.minimum_support = minimum_support
+        self.minimum_confidence = minimum_confidence
+        self.include_support_n_confidence = include_support_n_confidence
+        self.positive_no = positive_no
+        self.negative_no = negative_no
+        self.tree_factory = tree_factory
+        self.mode = mode
+        self.item_rank = item_rank
+        # Closed and maximal mining processes the items of every conditional
+        # tree in reverse path order, so support ties are broken along item_rank
+        self.tie_rank = item_rank if mode != 'all' else None
+        self.found = None
+        if mode == 'closed':
+            self.found = ItemsetIndex(item_rank)
+        elif mode == 'maximal':
+            self.found = FPTree()
+        self.top_k_key = None
+        self.top_k_floor = None
+
+def find_with_suffix(tree, suffix, mining):
+    """Generates the frequent itemsets of tree, each extended with suffix."""
+    if tree.no_branch:
+        # Pruning: directly output in this case
+        suffix_set = list(tree.item_order)
+        remaining_set = suffix_set
+        last_support = 0
+        candidates = []
+        for item in reversed(suffix_set):
+            support, pos_count = item_support(tree, item)
+            confidence = 0 if support == 0 else float(pos_count) / support
+            if last_support != 0 and last_support == support:
+                # Same support as the longer prefix, which covers it
                 remaining_set.pop(-1)
+                continue
+            if confidence >= mining.minimum_confidence:
+                if mining.include_support_n_confidence:
+                    candidates.append(((remaining_set + suffix), support, pos_count, confidence))
+                else:
+                    yield remaining_set
+            last_support = support
+            remaining_set.pop(-1)
+        if candidates:
+            chi_squares = chi_square_of([c[2] for c in candidates], [c[1] for c in candidates],
+                mining.positive_no, mining.negative_no)
+            for (itemset, support, pos_count, confidence), chi_square in zip(candidates, chi_squares):
+                yield itemset, support, pos_count, confidence, chi_square
+        return
+    for candidate in suffix_candidates(tree, suffix, mining):
+        # Build a conditional tree and recursively search for frequent
+        # itemsets within it, unless none of them can make the top k.
+        cond_tree = None
+        if may_extend(candidate, mining):
+            cond_tree = conditional_tree_from_base(tree.pattern_base(candidate[0]),
+                mining.minimum_support, mining.tree_factory)
+        for s in extend_suffix(cond_tree, candidate, suffix, mining):
+            yield s # pass along the good news to our caller
+
+def extend_suffix(cond_tree, candidate, suffix, mining):
+    """
+    Generates the itemset of candidate extending suffix, and then the
+    frequent itemsets of cond_tree, its conditional tree, if not None. In
+    closed and maximal mode see find_closed and find_maximal instead.
+    """
+    item, support, pos_count, confidence, chi_square = candidate
+    # Extend suffix
+    suffix_set = [item] + suffix
+    if mining.mode == 'closed':
+        for s in find_closed(cond_tree, suffix_set, support, pos_count, mining):
+            yield s
+        return
+    if mining.mode == 'maximal':
+        rank = mining.item_rank.__getitem__
+        for s in find_maximal(cond_tree, suffix_set, support, pos_count, mining, mining.found.pattern_base(item)):
+            mining.found.add(sorted(s[0], key=rank), 1, 0)
+            yield s
+        return
+    # yield only when confidence >= minimum_confidence
+    if confidence >= mining.minimum_confidence:
+        yield (suffix_set, support, pos_count, confidence, chi_square) if mining.include_support_n_confidence else suffix_set
+    if cond_tree is not None:
+        for s in find_with_suffix(cond_tree, suffix_set, mining):
+            yield s
+
+def find_closed(tree, head, support, pos_count, mining, checked=False):
+    """
+    CLOSET: generates (itemset, support, pos_count, confidence, None) of the
+    closed itemsets among head, of the given support and pos_count, and its
+    extensions by the items of tree, its conditional tree. Items of tree in
+    every transaction of head are merged into it. An extension contained in
+    a closed itemset of mining.found with the same support is skipped with
+    all of its own, and a single path tree is resolved without recursion.
+    checked tells that head is known not to be contained in one.
+    """
+    supports, merged, items = _merge_items(tree, support, mining)
+    head = merged + head
+    found = mining.found
+    if head:
+        if not found.add(head, (support, pos_count), checked):
             return
-        for item in reversed(tree.item_order):
-            _nodes = list(tree.nodes(item))
-            support, pos_count = sum(n.count for n in _nodes), sum(n.pos_count for n in _nodes)
+        yield head, support, pos_count, _confidence(support, pos_count), None
+    if tree.no_branch:
+        # The closed itemsets of a path end where the support drops
+        for index, item in enumerate(items):
+            if index + 1 < len(items) and supports[items[index + 1]][0] == supports[item][0]:
+                continue
+            itemset = items[:index + 1] + head
+            if found.add(itemset, supports[item]):
+                yield itemset, supports[item][0], supports[item][1], _confidence(*supports[item]), None
+        return
+    merged = set(merged)
+    for item in reversed(items):
+        if found.has_superset([item] + head, supports[item]):
+            continue
+        cond_tree = _conditional_tree(tree, item, merged, mining)
+        for s in find_closed(cond_tree, [item] + head, supports[item][0], supports[item][1], mining, True):
+            yield s
+
+def find_maximal(tree, head, support, pos_count, mining, mfi_base=()):
+    """
+    FPMax: generates (itemset, support, pos_count, confidence, None) of the
+    maximal itemsets among head, of the given support and pos_count, and its
+    extensions by the items of tree, its conditional tree. mfi_base is the
+    conditional pattern base of head in the MFI-tree of the maximal itemsets
+    found so far. head is skipped with all its extensions when one of them
+    holds every item of tree, and a single path tree is resolved without
+    recursion.
+    """
+    supports, merged, items = _merge_items(tree, support, mining)
+    head = merged + head
+    tail = set(items)
+    paths = [[item for item in path if item in tail] for path, _, _ in mfi_base]
+    if any(len(path) == len(items) for path in paths):
+        return
+    if tree.no_branch:
+        # Only the whole path can be maximal
+        if items:
+            support, pos_count = supports[items[-1]]
+        if items or head:
+            yield items + head, support, pos_count, _confidence(support, pos_count), None
+        return
+    rank = dict((item, index) for index, item in enumerate(items)).__getitem__
+    mfi_tree = FPTree()
+    for path in paths:
+        mfi_tree.add(sorted(path, key=rank), 1, 0)
+    merged = set(merged)
+    for item in reversed(items):
+        cond_tree = _conditional_tree(tree, item, merged, mining)
+        for s in find_maximal(cond_tree, [item] + head, supports[item][0], supports[item][1], mining,
+                mfi_tree.pattern_base(item)):
+            # The last item mined has no sibling left to prune
+            if item != items[0]:
+                mfi_tree.add(sorted((i for i in s[0] if i in tail), key=rank), 1, 0)
+            yield s
+
+def _merge_items(tree, support, mining):
+    """
+    Returns the supports and pos_counts of the items of tree, the items of
+    the given support, and the others in their path order: decreasing
+    support, ties along mining.item_rank.
+    """
+    item_order = tree.item_order
+    supports = dict((item, item_support(tree, item)) for item in item_order)
+    merged = [item for item in item_order if supports[item][0] == support]
+    rank = mining.item_rank
+    items = sorted((item for item in item_order if supports[item][0] != support),
+        key=lambda item: (-supports[item][0], rank[item]))
+    return supports, merged, items
+
+def _conditional_tree(tree, item, merged, mining):
+    """The conditional tree of item in tree, the merged items left out."""
+    base = tree.pattern_base(item)
+    if merged:
+        base = [([i for i in path if i not in merged], count, pos_count) for path, count, pos_count in base]
+    return conditional_tree_from_base(base, mining.minimum_support, mining.tree_factory, mining.tie_rank)
+
+def _confidence(support, pos_count):
+    return 0 if support == 0 else float(pos_count) / support
+
+class ItemsetIndex(object):
+    """
+    Itemsets stored as paths of a prefix tree, items sorted along rank, one
+    tree per key. The nodes of every item are linked from a header, so the
+    stored supersets of an itemset are found by walking up from the nodes of
+    its last item only, as in the MFI-tree of FPMax. Nodes are numbered and
+    kept in flat arrays, which the garbage collector does not have to scan.
+    """
+
+    def __init__(self, rank):
+        self._rank = rank
+        self._roots = {}
+        self._sizes = defaultdict(int)
+        self._items = []
+        self._parents = array('l')
+        self._depths = array('l')
+        # (node, item) -> child node, (key, item) -> array of its nodes
+        self._children = {}
+        self._headers = {}
+
+    def _node(self, item, parent, depth):
+        self._items.append(item)
+        self._parents.append(parent)
+        self._depths.append(depth)
+        return len(self._items) - 1
+
+    def add(self, itemset, key=None, checked=False):
+        """
+        Adds itemset under key, unless an itemset added before contains it,
+        which checked skips looking for. Returns whether it was added.
+        """
+        items = sorted(itemset, key=self._rank.__getitem__)
+        if not checked and self._find(key, items):
+            return False
+        node = self._roots.get(key)
+        if node is None:
+            node = self._roots[key] = self._node(None, -1, 0)
+        children = self._children
+        for item in items:
+            child = children.get((node, item))
+            if child is None:
+                child = children[node, item] = self._node(item, node, self._depths[node] + 1)
+                header = self._headers.get((key, item))
+                if header is None:
+                    header = self._headers[key, item] = array('l')
+                header.append(child)
+            node = child
+        self._sizes[key] += 1
+        return True
+
+    def has_superset(self, itemset, key=None):
+        """True if an itemset added under key contains itemset."""
+        return self._find(key, sorted(itemset, key=self._rank.__getitem__))
+
+    def _find(self, key, items):
+        if not items:
+            return self._sizes.get(key, 0) > 0
+        item_of, parents, depths = self._items, self._parents, self._depths
+        length = len(items)
+        for node in self._headers.get((key, items[-1]), ()):
+            if depths[node] < length:
+                continue
+            index = length - 2
+            parent = parents[node]
+            while index >= 0 and depths[parent] > index:
+                if item_of[parent] == items[index]:
+                    index -= 1
+                parent = parents[parent]
+            if index < 0:
+                return True
+        return False
+
+def closed_itemsets(results, minimum_confidence, mining, pooled=False):
+    """
+    Returns the results that have no superset of the same support among
+    results and reach minimum_confidence, in decreasing support, with their
+    chi-squares. Serial mining only generates closed itemsets; the workers
+    of a pool, each mining some items, do not see the itemsets of the others.
+    """
+    index = ItemsetIndex(mining.item_rank)
+    closed = []
+    for result in sorted(results, key=lambda r: (r[1], len(r[0])), reverse=True):
+        if not pooled or index.add(result[0], result[1:3]):
+            if result[3] >= minimum_confidence:
+                closed.append(result)
+    return with_chi_squares(closed, mining)
+
+def maximal_itemsets(results, minimum_confidence, mining, pooled=False):
+    """
+    Returns the results that have no superset among results and reach
+    minimum_confidence, longest first, with their chi-squares. As for
+    closed_itemsets, only pooled results need that check.
+    """
+    index = ItemsetIndex(mining.item_rank)
+    maximal = []
+    for result in sorted(results, key=lambda r: len(r[0]), reverse=True):
+        if not pooled or index.add(result[0]):
+            if result[3] >= minimum_confidence:
+                maximal.append(result)
+    return with_chi_squares(maximal, mining)
+
+def with_chi_squares(results, mining):
+    """Returns results with their chi-squares filled in, computed in one go."""
+    if not results:
+        return results
+    chi_squares = chi_square_of([r[2] for r in results], [r[1] for r in results],
+        mining.positive_no, mining.negative_no)
+    return [(r[0], r[1], r[2], r[3], chi_square) for r, chi_square in zip(results, chi_squares)]
+
+TOP_K_KEYS = {'chi_square': 4, 'confidence': 3, 'support': 1}
+
+def top_k_itemsets(results, k, key, mining=None):
+    """
+    Returns the k results with the largest key, one of TOP_K_KEYS, best
+    first. Once the heap is full its smallest key bounds the rest of the
+    search of mining: for support it becomes the minimum support, for
+    chi-square and confidence it is the top_k_floor below which
+    find_with_suffix stops extending a suffix, see may_extend.
+    """
+    index = TOP_K_KEYS[key]
+    if mining is not None:
+        mining.top_k_key = key
+    heap = []
+    for order, result in enumerate(results):
+        entry = (result[index], -order, result)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+        else:
+            continue
+        if len(heap) == k and mining is not None:
+            if key == 'support':
+                mining.minimum_support = max(mining.minimum_support, heap[0][0])
+            else:
+                mining.top_k_floor = heap[0][0]
+    return [entry[2] for entry in sorted(heap, key=lambda e: e[:2], reverse=True)]
+
+def may_extend(candidate, mining):
+    """
+    False if no frequent superset of candidate, (item, support, pos_count,
+    ...), can get a top_k_key above mining.top_k_floor. A superset has at
+    most pos_count positive and support - pos_count negative transactions,
+    and at least minimum_support in all. The chi-square of chi_square_of
+    falls as either count grows and is convex, so over these supersets it
+    peaks at one of the two ends of the minimum support line. Confidence
+    is at most pos_count / minimum_support.
+    """
+    if mining.top_k_floor is None:
+        return True
+    support, pos_count = candidate[1], candidate[2]
+    minimum = max(mining.minimum_support, 0)
+    if mining.top_k_key == 'confidence':
+        bound = 1.0 if pos_count >= minimum else float(pos_count) / minimum
+    else:
+        positive_no, negative_no = mining.positive_no, mining.negative_no
+        if positive_no == 0 or negative_no == 0:
+            return True
+        neg_count = support - pos_count
+        chi_square = lambda pos, neg: float(pos - positive_no) ** 2 / positive_no + float(neg - negative_no) ** 2 / negative_no
+        bound = max(chi_square(max(0, minimum - neg_count), min(neg_count, minimum)),
+            chi_square(min(pos_count, minimum), max(0, minimum - pos_count)))
+    return bound >= mining.top_k_floor
+
+def suffix_candidates(tree, suffix, mining):
+    """
+    Returns (item, support, pos_count, confidence, chi_square) of the items
+    of a branching tree that extend suffix, in the order they are mined.
+    chi_square is only computed for the itemsets that will be output.
+    """
+    candidates = []
+    for item in reversed(tree.item_order):
+        support, pos_count = item_support(tree, item)
+        if support >= mining.minimum_support and item not in suffix:
             confidence = 0 if support == 0 else float(pos_count) / support
-            chi_square = stats.chisquare(np.array([pos_count, support - pos_count]), np.array([positive_no, negative_no]))[0]
-            if support >= minimum_support and item not in suffix:
-                # Extend suffix
-                suffix_set = [item] + suffix
-                if confidence >= minimum_confidence:
-                    # yield only when confidence >= minimum_confidence
-                    yield (suffix_set, support, pos_count, confidence, chi_square) if include_support_n_confidence else suffix_set
-
-                # Build a conditional tree and recursively search for frequent
-                # itemsets within it.
-                cond_tree = modified_conditional_tree_from_paths(tree.prefix_paths(item),
-                    minimum_support)
-                for s in find_with_suffix(cond_tree, suffix_set):
-                    yield s # pass along the good news to our caller
-
-    # Search for frequent itemsets, and yield the results we find.
-    for itemset in find_with_suffix(master, []):
-        yield itemset
+            candidates.append([item, support, pos_count, confidence, None])
+    add_chi_squares(candidates, mining)
+    return candidates
+
+def add_chi_squares(candidates, mining):
+    """Fills in the chi-square of the candidates that will be output, in one go."""
+    outputs = [c for c in candidates if c[3] >= mining.minimum_confidence]
+    if mining.include_support_n_confidence and outputs:
+        chi_squares = chi_square_of([c[2] for c in outputs], [c[1] for c in outputs],
+            mining.positive_no, mining.negative_no)
+        for candidate, chi_square in zip(outputs, chi_squares):
+            candidate[4] = chi_square
+
+def find_in_parallel(tree, mining, workers):
+    """
+    Mines the conditional tree of every top-level item of tree in a pool of
+    workers, and generates the itemsets as the items are done. Items are
+    handed out largest estimated conditional tree first.
+    """
+    candidates = suffix_candidates(tree, [], mining)
+    # A prefix path of the item at position rank of item_order is at most rank + 1 long
+    rank = dict((item, index + 1) for index, item in enumerate(tree.item_order))
+    estimates = dict((c[0], rank[c[0]] * sum(1 for _ in tree.nodes(c[0]))) for c in candidates)
+    candidates.sort(key=lambda c: estimates[c[0]], reverse=True)
+    tasks = ((tree.pattern_base(c[0]), c, mining) for c in candidates)
+    return _imap_in_pool(_mine_item, tasks, workers)
+
+def _imap_in_pool(func, tasks, workers):
+    """
+    Applies func to every argument tuple of tasks in a pool of workers and
+    generates the items of the results, in task order. At most 2 * workers
+    tasks are drawn from tasks and in flight at once, so a lazy tasks keeps
+    only that many in memory.
+    """
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        tasks = iter(tasks)
+        while True:
+            for args in tasks:
+                pending.append(pool.apply_async(func, args))
+                if len(pending) >= 2 * workers:
+                    break
+            if len(pending) == 0:
+                break
+            for item in pending.popleft().get():
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def find_in_partitions(transactions, item_order, stats, mining, directory, workers=1):
+    """
+    Disk-partitioned mining. transactions are cleaned and sorted along
+    item_order, the frequent items in decreasing support; stats maps them to
+    their (support, pos_count). Every transaction is projected into the
+    partition file of each of its items, which so collects the item's
+    conditional pattern base. The partitions are then mined one at a time,
+    or in a pool of workers, least frequent item first, so only one
+    conditional tree is in memory at once. Partitions live in a temporary
+    directory under directory, removed when done.
+    """
+    work_dir = tempfile.mkdtemp(prefix='fp-partitions-', dir=directory)
+    try:
+        project_partitions(transactions, item_order, work_dir)
+        candidates = []
+        for rank in reversed(xrange(len(item_order))):
+            support, pos_count = stats[item_order[rank]]
+            confidence = 0 if support == 0 else float(pos_count) / support
+            candidates.append([rank, support, pos_count, confidence, None])
+        add_chi_squares(candidates, mining)
+        if workers > 1:
+            tasks = ((partition_file(work_dir, c[0]), [item_order[c[0]]] + c[1:], mining)
+                for c in candidates if c[1] >= mining.minimum_support)
+            for itemset in _imap_in_pool(_mine_partition, tasks, workers):
+                yield itemset
+            return
+        for candidate in candidates:
+            if candidate[1] < mining.minimum_support:
+                continue
+            cond_tree = None
+            if mining.mode != 'all' or may_extend(candidate, mining):
+                cond_tree = conditional_tree_from_base(read_partition(partition_file(work_dir, candidate[0])),
+                    mining.minimum_support, mining.tree_factory, mining.tie_rank)
+            for itemset in extend_suffix(cond_tree, [item_order[candidate[0]]] + candidate[1:], [], mining):
+                yield itemset
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def partition_file(directory, rank):
+    """The partition of the item at position rank of the item order."""
+    return os.path.join(directory, 'part-{0}.pkl'.format(rank))
+
+def project_partitions(transactions, item_order, directory, buffer_size=100000):
+    """
+    Appends (prefix, count, pos_count) to the partition of every item of
+    every transaction, the prefix being the items before it. Records are
+    buffered, at most buffer_size of them, then appended to their files.
+    """
+    rank_of = dict((item, rank) for rank, item in enumerate(item_order))
+    buffers = defaultdict(list)
+    buffered = 0
+    for trans, count, pos_count in transactions:
+        for index in xrange(1, len(trans)):
+            buffers[rank_of[trans[index]]].append((trans[:index], count, pos_count))
+            buffered += 1
+        if buffered >= buffer_size:
+            _flush_partitions(buffers, directory)
+            buffered = 0
+    _flush_partitions(buffers, directory)
+
+def _flush_partitions(buffers, directory):
+    for rank, records in buffers.iteritems():
+        with open(partition_file(directory, rank), 'ab') as f:
+            cPickle.dump(records, f, cPickle.HIGHEST_PROTOCOL)
+    buffers.clear()
+
+def read_partition(file_name):
+    """Returns the (prefix, count, pos_count) records of a partition file."""
+    return PartitionBase(file_name)
+
+class PartitionBase(object):
+    """
+    The records of a partition file, read back chunk by chunk from disk on
+    every iteration, so a pattern base larger than memory can be iterated
+    as often as conditional_tree_from_base needs.
+    """
+    def __init__(self, file_name):
+        self._file_name = file_name
+
+    def __iter__(self):
+        if not os.path.isfile(self._file_name):
+            return
+        with open(self._file_name, 'rb') as f:
+            while True:
+                try:
+                    records = cPickle.load(f)
+                except EOFError:
+                    break
+                for record in records:
+                    yield record
+
+def _mine_partition(file_name, candidate, mining):
+    cond_tree = conditional_tree_from_base(read_partition(file_name), mining.minimum_support, mining.tree_factory,
+        mining.tie_rank)
+    return list(extend_suffix(cond_tree, candidate, [], mining))
+
+def _mine_item(base, candidate, mining):
+    cond_tree = conditional_tree_from_base(base, mining.minimum_support, mining.tree_factory, mining.tie_rank)
+    return list(extend_suffix(cond_tree, candidate, [], mining))
+
+def item_support(tree, item):
+    """Returns the support and pos_count of item in tree."""
+    support = pos_count = 0
+    for node in tree.nodes(item):
+        support += node.count
+        pos_count += node.pos_count
+    return support, pos_count
+
+def chi_square_of(pos_counts, supports, positive_no, negative_no):
+    """
+    Returns the chi-square statistics of many itemsets at once, the same as
+    stats.chisquare([pos_count, support - pos_count], [positive_no, negative_no])
+    for each of them.
+    """
+    pos_counts = np.asarray(pos_counts, dtype=np.float64)
+    neg_counts = np.asarray(supports, dtype=np.float64) - pos_counts
+    return (pos_counts - positive_no) ** 2 / positive_no + (neg_counts - negative_no) ** 2 / negative_no
 
 class FPTree(object):
     """
@@ -143,7 +761,7 @@ class FPTree(object):
         self._no_branch = True
         # Use this to keep the order of items inserted into the tree.
         # The order in _routes is not reliable.
-        self._item_order = []
+        self._item_order = OrderedDict()
 
     @property
     def root(self):
@@ -193,7 +811,8 @@ class FPTree(object):
                 # Create a new point and add it as a child of the point we're
                 # currently looking at.
                 next_point = FPNode(self, item, count, pos_count)
-                point.add(next_point)
+                point._children[item] = next_point
+                next_point._parent = point
                 if len(point._children) > 1:
                     self._no_branch = False
                 # Update the route of nodes that contain this item to include
@@ -208,12 +827,13 @@ class FPTree(object):
 
         try:
             route = self._routes[point.item]
-            route[1].neighbor = point # route[1] is the tail
+            route[1]._neighbor = point # route[1] is the tail
+            point._prev = route[1]
             self._routes[point.item] = self.Route(route[0], point)
         except KeyError:
             # First node for this item; start a new route.
             self._routes[point.item] = self.Route(point, point)
-            self._item_order.append(point.item)
+            self._item_order[point.item] = None
 
     def items(self):
         """
@@ -251,6 +871,22 @@ class FPTree(object):
 
         return (collect_path(node) for node in self.nodes(item))
 
+    def pattern_base(self, item):
+        """
+        Returns the conditional pattern base of item: (items, count, pos_count)
+        of every prefix path that ends with item, the item itself excluded.
+        """
+        base = []
+        for node in self.nodes(item):
+            path = []
+            parent = node._parent
+            while parent is not None and parent._item is not None:
+                path.append(parent._item)
+                parent = parent._parent
+            path.reverse()
+            base.append((path, node._count, node._pos_count))
+        return base
+
     def inspect(self):
         print 'Tree:'
         self.root.inspect(1)
@@ -266,20 +902,18 @@ class FPTree(object):
         """Called when `node` is removed from the tree; performs cleanup."""
 
         head, tail = self._routes[node.item]
-        if node is head:
-            if node is tail or not node.neighbor:
-                # It was the sole node.
-                del self._routes[node.item]
-            else:
-                self._routes[node.item] = self.Route(node.neighbor, tail)
-                self._item_order = filter(lambda x: x != node.item, self._item_order)
+        prev, neighbor = node._prev, node._neighbor
+        if node is head and node is tail:
+            # It was the sole node.
+            del self._routes[node.item]
+            del self._item_order[node.item]
         else:
-            for n in self.nodes(node.item):
-                if n.neighbor is node:
-                    n.neighbor = node.neighbor # skip over
-                    if node is tail:
-                        self._routes[node.item] = self.Route(head, n)
-                    break
+            # Skip over, in both directions
+            if prev is not None:
+                prev._neighbor = neighbor
+            if neighbor is not None:
+                neighbor._prev = prev
+            self._routes[node.item] = self.Route(neighbor if node is head else head, prev if node is tail else tail)
 
     @property
     def no_branch(self):
@@ -293,47 +927,47 @@ class FPTree(object):
 
     @property
     def item_order(self):
-        """Return _item_order"""
-        return self._item_order
+        """Return the items in the order they were inserted into the tree."""
+        return self._item_order.keys()
 
-def modified_conditional_tree_from_paths(paths, minimum_support):
+def modified_conditional_tree_from_paths(paths, minimum_support, tree_factory=None):
     """
     Modified version of conditional_tree_from_paths.
     Generally, when build a modified conditional tree, we should also
     sort all the nodes, remove nodes that does not meet the minimun
     support -- this will reduce the execution time and memory.
     """
-    condition_item = None
-    items = defaultdict(lambda: 0) # mapping from items to their supports
-    processed_transactions = []
+    base = [([node.item for node in path[:-1]], path[-1].count, path[-1].pos_count) for path in paths]
+    return conditional_tree_from_base(base, minimum_support, tree_factory)
 
-    # Stat_Trans for transaction with count and pos_count
-    Stat_Trans = namedtuple('Labeled_Trans', 'trans stat')
-
-    for path in paths:
-        if condition_item is None:
-            condition_item = path[-1].item
-        count, pos_count = path[-1].count, path[-1].pos_count
-        processed = []
-        for node in path:
-            items[node.item] += count
-            processed.append(node.item)
-        processed_transactions.append(Stat_Trans(processed, (count, pos_count)))
+def conditional_tree_from_base(base, minimum_support, tree_factory=None, item_rank=None):
+    """
+    Builds a conditional tree from a conditional pattern base, a list of
+    (items, count, pos_count) as returned by pattern_base or any iterable of
+    them that can be iterated twice: items below the minimum support are
+    dropped and the rest sorted by decreasing support, ties along item_rank
+    if given.
+    """
+    if tree_factory is None:
+        tree_factory = FPTree
+    items = defaultdict(lambda: 0) # mapping from items to their supports
+    for path, count, pos_count in base:
+        for item in path:
+            items[item] += count
 
-    items.pop(condition_item, None)
     items = dict((item, support) for item, support in items.iteritems() if support >= minimum_support)
-    res = list(sorted(items, key=items.__getitem__, reverse=True))
+    if item_rank is None:
+        res = list(sorted(items, key=items.__getitem__, reverse=True))
+    else:
+        res = sorted(items, key=lambda item: (-items[item], item_rank[item]))
     order_items = dict((item, order) for item, order in zip(res, range(len(res))))
 
-    def clean_transaction(transaction):
-        cleaned_transaction = filter(lambda v: v in order_items, transaction.trans)
-        cleaned_transaction.sort(key=lambda v: order_items[v], reverse=False)
-        return Stat_Trans(cleaned_transaction, transaction.stat)
-
-    master = FPTree()
-    for transaction in imap(clean_transaction, processed_transactions):
-        master.add(transaction.trans, transaction.stat[0], transaction.stat[1])
-    return master
+    tree = tree_factory()
+    for path, count, pos_count in base:
+        cleaned = [item for item in path if item in order_items]
+        cleaned.sort(key=order_items.__getitem__)
+        tree.add(cleaned, count, pos_count)
+    return tree
 
 def conditional_tree_from_paths(paths, minimum_support):
     """Builds a conditional FP-tree from the given prefix paths."""
@@ -401,6 +1035,7 @@ class FPNode(object):
         self._parent = None
         self._children = {}
         self._neighbor = None
+        self._prev = None # the node whose neighbor this node is
 
     def add(self, child):
         """Adds the given FPNode `child` as a child of this node."""
@@ -539,28 +1174,246 @@ class FPNode(object):
         return "<%s %r (%r)>" % (type(self).__name__, self.item, self.count)
 
 
+class CompactFPTree(object):
+    """
+    An FP tree holding its nodes in parallel typed arrays indexed by node id,
+    with the same surface as FPTree. Node 0 is the root.
+
+    Items are mapped to dense ids; the children of all nodes share one dict
+    keyed by (node id << 32 | item id). Nodes are handed out as
+    CompactFPNode views, created on demand.
+    """
+
+    def __init__(self):
+        self._item_ids = {}
+        self._item_list = []
+        self._item_order = []
+        # Head and tail node of the route of every item id
+        self._heads = array('i')
+        self._tails = array('i')
+        self._items = array('i', [-1])
+        self._counts = array('l', [0])
+        self._pos_counts = array('l', [0])
+        self._parents = array('i', [-1])
+        self._neighbors = array('i', [0])
+        self._has_child = bytearray(1)
+        self._children = {}
+        self._no_branch = True
+
+    def __len__(self):
+        """The number of nodes, the root excluded."""
+        return len(self._items) - 1
+
+    @property
+    def root(self):
+        """The root node of the tree."""
+        return CompactFPNode(self, 0)
+
+    def _item_id(self, item):
+        try:
+            return self._item_ids[item]
+        except KeyError:
+            item_id = len(self._item_list)
+            self._item_ids[item] = item_id
+            self._item_list.append(item)
+            self._heads.append(0)
+            self._tails.append(0)
+            return item_id
+
+    def add(self, transaction, count, pos_count):
+        """
+        Adds a transaction to the tree, with count and pos_count.
+        """
+        point = 0
+        for item in transaction:
+            item_id = self._item_id(item)
+            key = (point << 32) | item_id
+            next_point = self._children.get(key)
+            if next_point is not None:
+                self._counts[next_point] += count
+                self._pos_counts[next_point] += pos_count
+            else:
+                next_point = len(self._items)
+                self._items.append(item_id)
+                self._counts.append(count)
+                self._pos_counts.append(pos_count)
+                self._parents.append(point)
+                self._neighbors.append(0)
+                self._has_child.append(0)
+                self._children[key] = next_point
+                if self._has_child[point]:
+                    self._no_branch = False
+                self._has_child[point] = 1
+                self._update_route(item_id, next_point)
+            point = next_point
+
+    def _update_route(self, item_id, node_id):
+        tail = self._tails[item_id]
+        if tail:
+            self._neighbors[tail] = node_id
+        else:
+            # First node for this item; start a new route.
+            self._heads[item_id] = node_id
+            self._item_order.append(self._item_list[item_id])
+        self._tails[item_id] = node_id
+
+    def items(self):
+        for item in self._item_list:
+            yield (item, self.nodes(item))
+
+    def nodes(self, item):
+        """
+        Generates the sequence of nodes that contain the given item.
+        """
+        try:
+            node_id = self._heads[self._item_ids[item]]
+        except KeyError:
+            return
+        while node_id:
+            yield CompactFPNode(self, node_id)
+            node_id = self._neighbors[node_id]
+
+    def prefix_paths(self, item):
+        """Generates the prefix paths that end with the given item."""
+
+        def collect_path(node_id):
+            path = []
+            while node_id > 0:
+                path.append(CompactFPNode(self, node_id))
+                node_id = self._parents[node_id]
+            path.reverse()
+            return path
+
+        return (collect_path(node.node_id) for node in self.nodes(item))
+
+    def pattern_base(self, item):
+        """
+        Returns the conditional pattern base of item: (items, count, pos_count)
+        of every prefix path that ends with item, the item itself excluded.
+        """
+        item_list, items, parents = self._item_list, self._items, self._parents
+        base = []
+        try:
+            node_id = self._heads[self._item_ids[item]]
+        except KeyError:
+            return base
+        while node_id:
+            path = []
+            parent = parents[node_id]
+            while parent > 0:
+                path.append(item_list[items[parent]])
+                parent = parents[parent]
+            path.reverse()
+            base.append((path, self._counts[node_id], self._pos_counts[node_id]))
+            node_id = self._neighbors[node_id]
+        return base
+
+    @property
+    def no_branch(self):
+        """Return if this tree has branches or not."""
+        return self._no_branch
+
+    @property
+    def item_order(self):
+        """Return _item_order"""
+        return self._item_order
+
+class CompactFPNode(object):
+    """A read-only view of a node of a CompactFPTree."""
+
+    __slots__ = ('_tree', '_id')
+
+    def __init__(self, tree, node_id):
+        self._tree = tree
+        self._id = node_id
+
+    @property
+    def node_id(self):
+        return self._id
+
+    @property
+    def tree(self):
+        return self._tree
+
+    @property
+    def item(self):
+        if self._id == 0:
+            return None
+        return self._tree._item_list[self._tree._items[self._id]]
+
+    @property
+    def count(self):
+        return self._tree._counts[self._id]
+
+    @property
+    def pos_count(self):
+        return self._tree._pos_counts[self._id]
+
+    @property
+    def root(self):
+        return self._id == 0
+
+    @property
+    def parent(self):
+        if self._id == 0:
+            return None
+        return CompactFPNode(self._tree, self._tree._parents[self._id])
+
+    @property
+    def neighbor(self):
+        node_id = self._tree._neighbors[self._id]
+        return CompactFPNode(self._tree, node_id) if node_id else None
+
+    def __eq__(self, other):
+        return isinstance(other, CompactFPNode) and self._tree is other._tree and self._id == other._id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self.root:
+            return "<%s (root)>" % type(self).__name__
+        return "<%s %r (%r)>" % (type(self).__name__, self.item, self.count)
+
+
 if __name__ == '__main__':
     from optparse import OptionParser
-    import csv
 
     p = OptionParser(usage='%prog data_file')
     p.add_option('-s', '--minimum-support', dest='minsup', type='int',
         help='Minimum itemset support (default: 2)')
     p.add_option('-c', '--minimum-confidence', dest='minconf', type='float',
         help='Minimum confidence (float value in [0, 1], default: 0.5)')
+    p.add_option('--compact', dest='compact', action='store_true',
+        help='Build array-backed trees (CompactFPTree) to save memory')
+    p.add_option('-w', '--workers', dest='workers', type='int',
+        help='Number of processes mining top-level items (default: 1)')
+    p.add_option('-m', '--mode', dest='mode', choices=MODES,
+        help='Itemsets to output: all, closed or maximal (default: all)')
+    p.add_option('-k', '--top-k', dest='top_k', type='int',
+        help='Only output the k best itemsets (default: 0, all)')
+    p.add_option('--top-k-key', dest='top_k_key', choices=sorted(TOP_K_KEYS),
+        help='Ranking of --top-k: chi_square, confidence or support (default: chi_square)')
+    p.add_option('--weighted', dest='weighted', action='store_true',
+        help='Read (items, count, pos_count) records from a trans_stat file with a '
+        'pos_count column or a binary transaction store instead of labelled CSV rows')
+    p.add_option('-p', '--partition-dir', dest='partition_dir',
+        help='Mine item partitions projected into this directory instead of a master tree in memory')
     p.set_defaults(minsup=2)
+    p.set_defaults(mode='all')
+    p.set_defaults(top_k=0)
+    p.set_defaults(top_k_key='chi_square')
+    p.set_defaults(workers=1)
     p.set_defaults(minconf=0.5)
 
     options, args = p.parse_args()
     if len(args) < 1:
-        p.error('must provide the path to a CSV file to read')
+        p.error('must provide the path to a CSV file (or with --weighted a trans_stat file or store) to read')
 
-    f = open(args[0])
     start_time =  time.time()
-    try:
-        for itemset, support, pos_count, confidence, chi_square in find_frequent_itemsets(csv.reader(f), options.minsup, options.minconf, True):
-            print '{' + ', '.join(itemset) + '} ' + str(support) + ' ' + str(pos_count) + ' ' + str(confidence) + ' ' + str(chi_square)
-    finally:
-        f.close()
+    for itemset, support, pos_count, confidence, chi_square in find_frequent_itemsets(args[0], options.minsup, options.minconf, True,
+        CompactFPTree if options.compact else None, options.workers, options.mode, options.top_k, options.top_k_key,
+        options.weighted, options.partition_dir):
+        print '{' + ', '.join(itemset) + '} ' + str(support) + ' ' + str(pos_count) + ' ' + str(confidence) + ' ' + str(chi_square)
     elapsed_time =  time.time() - start_time
     print "Elapsed time:", elapsed_time
@@ -0,0 +1,159 @@
+"""
+Input helpers for service logs spread over several, possibly compressed, files.
+"""
+import bz2
+import glob
+import gzip
+import threading
+import subprocess
+from Queue import Queue, Full
+from cStringIO import StringIO
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+_MAGIC = [('\x1f\x8b', 'gzip'), ('BZh', 'bz2'), ('\xfd7zXZ\x00', 'xz')]
+_CHUNK_SIZE = 1 << 20
+_QUEUE_SIZE = 16
+
+
+def expand_inputs(file_name):
+    """Expands a path, a glob pattern or a list of them into a sorted file list"""
+    names = file_name if isinstance(file_name, list) else [file_name]
+    files = []
+    for name in names:
+        matched = sorted(glob.glob(name))
+        if len(matched) == 0:
+            raise Exception('{0} does not match any file.'.format(name))
+        files.extend(matched)
+    return files
+
+def detect_compression(file_name):
+    """Returns 'gzip', 'bz2', 'xz' or None, judged by the magic bytes"""
+    with open(file_name, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in _MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def open_log(file_name):
+    """Opens a log file for reading, decompressing on the fly"""
+    compression = detect_compression(file_name)
+    if compression == 'gzip':
+        return gzip.open(file_name, 'rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(file_name, 'rb')
+    if compression == 'xz':
+        if lzma is not None:
+            return lzma.open(file_name, 'rb')
+        # No lzma module on python 2, xz itself does the work in its own process
+        return _XzReader(file_name)
+    return open(file_name, 'r')
+
+
+class _XzReader(object):
+    """
+        Output of an `xz -dc` process as a file. The exit status is checked at
+        the end of the output, so a truncated or corrupt file raises IOError
+        like gzip and bz2 do; closing early kills the process.
+    """
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._process = subprocess.Popen(['xz', '-dc', file_name], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, bufsize=_CHUNK_SIZE)
+
+    def _finish(self):
+        if self._process.wait() != 0:
+            raise IOError('xz failed on {0}: {1}'.format(self._file_name, self._process.stderr.read().strip()))
+
+    def read(self, size=-1):
+        data = self._process.stdout.read(size)
+        if not data:
+            self._finish()
+        return data
+
+    def __iter__(self):
+        for line in self._process.stdout:
+            yield line
+        self._finish()
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._process.stdout.close()
+        self._process.stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _put(queue, item, stopped):
+    """Puts item into queue unless stopped is set first; returns if it did"""
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+def _read_blocks(f, queue, stopped):
+    """Puts newline-terminated blocks of f into queue, then None.
+       Gives up once stopped is set, when the consumer went away.
+    """
+    try:
+        rest = ''
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            block = rest + chunk
+            end = block.rfind('\n') + 1
+            rest = block[end:]
+            if end > 0 and not _put(queue, block[:end], stopped):
+                return
+        if rest and not _put(queue, rest, stopped):
+            return
+        _put(queue, None, stopped)
+    except Exception as e:
+        _put(queue, e, stopped)
+    finally:
+        f.close()
+
+def iter_lines(file_name, threaded=True):
+    """Generates the lines of a log file.
+       Compressed files are decompressed in a reader thread when threaded is
+       set, overlapping decompression with the parsing of earlier lines.
+    """
+    if not threaded or detect_compression(file_name) is None:
+        with open_log(file_name) as f:
+            for line in f:
+                yield line
+        return
+    queue = Queue(_QUEUE_SIZE)
+    stopped = threading.Event()
+    reader = threading.Thread(target=_read_blocks, args=(open_log(file_name), queue, stopped))
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            block = queue.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            for line in StringIO(block):
+                yield line
+    finally:
+        # Also reached when the consumer stops early: the reader closes the file
+        stopped.set()
+        reader.join()
@@ -1,5 +1,14 @@
+import hashlib
 
 def check_keys(keys, d, d_name, tp):
     for key in keys:
         if key not in d or not isinstance(d[key],tp):
             raise Exception('Key {0} not found in {1} or its value is not {2}.'.format(key, d_name, tp))
+
+def file_digest(file_name):
+    """Returns the md5 hex digest of the content of a file"""
+    digest = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
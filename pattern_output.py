@@ -0,0 +1,107 @@
+"""
+Writers for the results of ActionPatternMiner.
+
+Every writer produces an action pattern output and a pattern stat output in
+a directory:
+    tsv       action_pattern.txt, pattern_stat.txt (the historical layout)
+    jsonl     action_pattern.jsonl, pattern_stat.jsonl, one JSON record a line
+    columnar  action_pattern.npz, pattern_stat.npz, one NumPy array a column
+"""
+import os
+import json
+import numpy as np
+
+FORMATS = ('tsv', 'jsonl', 'columnar')
+
+
+def open_pattern_writer(output_format, directory):
+    if output_format not in FORMATS:
+        raise Exception('Output format {0} is not one of {1}.'.format(output_format, FORMATS))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if output_format == 'tsv':
+        return TsvPatternWriter(directory)
+    if output_format == 'jsonl':
+        return JsonLinesPatternWriter(directory)
+    return ColumnarPatternWriter(directory)
+
+
+class TsvPatternWriter(object):
+    def __init__(self, directory):
+        self._pattern_file = open(os.path.join(directory, 'action_pattern.txt'), 'w')
+        self._stat_file = open(os.path.join(directory, 'pattern_stat.txt'), 'w')
+
+    def begin_action(self, reason, action):
+        self._pattern_file.write('{0}\t{1}:\n'.format(reason, action))
+
+    def pattern(self, reason, action, pattern, freq):
+        self._pattern_file.write('{0}:{1},{2}\t{3}\n'.format(reason, ','.join(pattern) if pattern else 'Nil', action, freq))
+
+    def stat(self, action, total, items):
+        """items are (item, probability) in decreasing probability"""
+        item_with_freq = ['{0}({1:.2f})'.format(item, prob) for item, prob in items]
+        self._stat_file.write('{0} : {1}...\n'.format(action, ','.join(item_with_freq)))
+
+    def close(self):
+        self._pattern_file.close()
+        self._stat_file.close()
+
+
+class JsonLinesPatternWriter(object):
+    def __init__(self, directory):
+        self._pattern_file = open(os.path.join(directory, 'action_pattern.jsonl'), 'w')
+        self._stat_file = open(os.path.join(directory, 'pattern_stat.jsonl'), 'w')
+
+    def begin_action(self, reason, action):
+        pass
+
+    def pattern(self, reason, action, pattern, freq):
+        record = {"reason": reason, "action": action, "pattern": list(pattern), "freq": freq}
+        self._pattern_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def stat(self, action, total, items):
+        record = {"action": action, "total": total, "items": [{"item": item, "prob": prob} for item, prob in items]}
+        self._stat_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self._pattern_file.close()
+        self._stat_file.close()
+
+
+class ColumnarPatternWriter(object):
+    """Buffers the columns and writes them with numpy.savez on close.
+       Patterns are stored as comma-joined labels, stats one row per item.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+        self._patterns = {"reason": [], "action": [], "pattern": [], "freq": []}
+        self._stats = {"action": [], "total": [], "item": [], "prob": []}
+
+    def begin_action(self, reason, action):
+        pass
+
+    def pattern(self, reason, action, pattern, freq):
+        self._patterns["reason"].append(reason)
+        self._patterns["action"].append(action)
+        self._patterns["pattern"].append(','.join(pattern))
+        self._patterns["freq"].append(freq)
+
+    def stat(self, action, total, items):
+        for item, prob in items:
+            self._stats["action"].append(action)
+            self._stats["total"].append(total)
+            self._stats["item"].append(item)
+            self._stats["prob"].append(prob)
+
+    def close(self):
+        for name, columns in [('action_pattern', self._patterns), ('pattern_stat', self._stats)]:
+            arrays = {}
+            for column, values in columns.iteritems():
+                if column in ("freq", "total"):
+                    arrays[column] = np.array(values, dtype=np.int64)
+                elif column == "prob":
+                    arrays[column] = np.array(values, dtype=np.float64)
+                else:
+                    # utf-8 bytes, fixed width
+                    arrays[column] = np.array(values, dtype=np.string_)
+            np.savez(os.path.join(self._directory, name + '.npz'), **arrays)
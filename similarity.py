@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 import math
+import numpy as np
+from scipy import sparse
+from collections import Counter
 
 def remove_stop_words(words):
     stop_words = set([" ", "-", u"―"])
@@ -34,6 +37,49 @@ def simple_similarity(words1, words2):
     #raw_input("press any key to continue")
     return sum(words1_vec[i]*words2_vec[i] for i in range(0, len(word_to_index)))
 
+class SparseSimilarity(object):
+    """
+        Scores token bags against a fixed list of token bags at once.
+        The bags are encoded once as the L2-normalised rows of a CSR matrix,
+        a query is one sparse matrix product. Scores are the cosines
+        simple_similarity computes, up to rounding.
+    """
+    def __init__(self, bags):
+        self._word_to_index = {}
+        self._matrix = self._encode(bags, grow=True).tocsr()
+
+    def __len__(self):
+        return self._matrix.shape[0]
+
+    def _encode(self, bags, grow=False):
+        """Returns the normalised bags as a sparse matrix. Words out of the
+           vocabulary only count in the norm, they can not match anything.
+        """
+        rows, cols, data = [], [], []
+        for row, words in enumerate(bags):
+            bag = Counter(remove_stop_words(words))
+            norm = math.sqrt(sum(x*x for x in bag.itervalues()))
+            for word, count in bag.iteritems():
+                index = self._word_to_index.get(word)
+                if index is None:
+                    if not grow:
+                        continue
+                    index = len(self._word_to_index)
+                    self._word_to_index[word] = index
+                rows.append(row)
+                cols.append(index)
+                data.append(count / norm)
+        return sparse.coo_matrix((data, (rows, cols)), shape=(len(bags), len(self._word_to_index)))
+
+    def scores(self, words):
+        """Returns the cosine of words against every bag"""
+        return self.scores_batch([words])[0]
+
+    def scores_batch(self, bags):
+        """Returns a len(bags) x len(self) array of cosines"""
+        queries = self._encode(bags).tocsr()
+        return np.asarray(queries.dot(self._matrix.T).todense())
+
 def main():
     """
         use main for simple testing
@@ -0,0 +1,140 @@
+"""
+Binary columnar storage of transaction statistics.
+
+A store with prefix P consists of
+    P.meta       JSON with the code list and the dtypes of the columns
+    P.codes      flat array of code ids of all transactions
+    P.offsets    transaction i owns codes[offsets[i]:offsets[i+1]]
+    P.counts     frequency of every transaction
+    P.pos_counts positive-class frequency of every transaction (optional)
+All columns are raw native arrays, readable through numpy.memmap.
+"""
+import os
+import sys
+import json
+from array import array
+import numpy as np
+
+VERSION = 1
+_BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+
+def _dtype_of(typecode):
+    kind = 'u' if typecode.isupper() else 'i'
+    return '{0}{1}{2}'.format(_BYTE_ORDER, kind, array(typecode).itemsize)
+
+def is_trans_store(prefix):
+    return os.path.isfile(prefix + '.meta')
+
+def write_trans_store(prefix, records, codes, with_pos_counts=False):
+    """Writes (code ids, count[, pos_count]) records into the store at prefix.
+       codes is the code list the ids refer to.
+    """
+    offsets = array('l', [0])
+    counts = array('l')
+    pos_counts = array('l')
+    with open(prefix + '.codes', 'wb') as f:
+        for record in records:
+            code_ids = record[0]
+            if not isinstance(code_ids, array):
+                code_ids = array('H', code_ids)
+            code_ids.tofile(f)
+            offsets.append(offsets[-1] + len(code_ids))
+            counts.append(record[1])
+            if with_pos_counts:
+                pos_counts.append(record[2])
+    columns = [('offsets', offsets), ('counts', counts)]
+    if with_pos_counts:
+        columns.append(('pos_counts', pos_counts))
+    for name, column in columns:
+        with open('{0}.{1}'.format(prefix, name), 'wb') as f:
+            column.tofile(f)
+    meta = {
+        "version": VERSION,
+        "codes": list(codes),
+        "trans_number": len(counts),
+        "code_dtype": _dtype_of('H'),
+        "column_dtype": _dtype_of('l'),
+        "pos_counts": with_pos_counts
+    }
+    # meta is written last, so a store is only visible once it is complete
+    with open(prefix + '.meta', 'w') as f:
+        json.dump(meta, f)
+
+def read_trans(file_name, code_dict):
+    """Generates (code ids, frequency) from either a trans_stat text file
+       or a binary store, with ids of code_dict.
+    """
+    if not is_trans_store(file_name):
+        for record in code_dict.read_trans_file(file_name):
+            yield record
+        return
+    store = TransStore(file_name)
+    remap = np.array([code_dict.encode(code) for code in store.codes], dtype=np.int64)
+    for code_ids, count in store:
+        yield remap[code_ids].tolist(), int(count)
+
+
+class TransStore(object):
+    """
+        Read-only, memory mapped view of a binary transaction store.
+        Pages are shared between processes mapping the same store.
+    """
+    def __init__(self, prefix):
+        with open(prefix + '.meta', 'r') as f:
+            meta = json.load(f)
+        if meta.get("version") != VERSION:
+            raise Exception('{0} has unsupported version {1}.'.format(prefix, meta.get("version")))
+        self._codes = [str(code) for code in meta["codes"]]
+        self._trans_number = meta["trans_number"]
+        self._offsets = self._map(prefix + '.offsets', meta["column_dtype"])
+        self._counts = self._map(prefix + '.counts', meta["column_dtype"])
+        self._code_ids = self._map(prefix + '.codes', meta["code_dtype"])
+        self._pos_counts = None
+        if meta["pos_counts"]:
+            self._pos_counts = self._map(prefix + '.pos_counts', meta["column_dtype"])
+
+    def _map(self, file_name, dtype):
+        # numpy can not map empty files
+        if os.path.getsize(file_name) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_name, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self._trans_number
+
+    @property
+    def codes(self):
+        """The code list the ids in this store refer to"""
+        return self._codes
+
+    @property
+    def code_ids(self):
+        return self._code_ids
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def pos_counts(self):
+        return self._pos_counts
+
+    def trans(self, index):
+        return self._code_ids[self._offsets[index]:self._offsets[index + 1]]
+
+    def __iter__(self):
+        """Generates (code ids, count) of every transaction"""
+        for index in xrange(self._trans_number):
+            yield self.trans(index), self._counts[index]
+
+    def records(self):
+        """Generates (code ids, count, pos_count) of every transaction"""
+        if self._pos_counts is None:
+            raise Exception('The store has no pos_counts.')
+        for index in xrange(self._trans_number):
+            yield self.trans(index), self._counts[index], self._pos_counts[index]